@@ -0,0 +1,59 @@
+from fastapi import APIRouter, Depends
+from core.config import Settings, get_settings
+from db.indexes import audit_query_plans, get_missing_unique_indexes
+from db.mongodb import get_database
+from db.monitoring import get_pool_stats, get_slow_queries
+from services.cache import get_cache_stats
+from services.archive import archive_allocations, get_archived_months
+from services.rollup import rebuild_rollups
+
+router = APIRouter()
+
+@router.get("/query-plans", status_code=200)
+async def get_query_plans(db = Depends(get_database)):
+    """Explain every hot query issued by the routers and flag the ones which still scan the whole collection. Unique
+    indexes which could not be created are listed as *missing_unique_indexes*"""
+    queries = await audit_query_plans(db)
+    return {"collection_scans": sum(query['collection_scan'] for query in queries),
+            "missing_unique_indexes": await get_missing_unique_indexes(db), "queries": queries}
+
+@router.post("/rollups/rebuild", status_code=200)
+async def rebuild_allocation_rollups(db = Depends(get_database)):
+    """Recompute the daily allocation counters used by the reports from the allocation history. Reports keep reading
+    the current counters and allocations are written as usual until the rebuild switches over"""
+    try:
+        rollups = await rebuild_rollups(db)
+    except FileNotFoundError as error:
+        return {"message": f"Allocation rollups not rebuilt: {error}"}
+    if rollups is None:
+        return {"message": "Allocation rollups are being rebuilt by another worker, try again later"}
+    return {"message": "Allocation rollups rebuilt successfully", "rollups": rollups}
+
+@router.get("/cache", status_code=200)
+async def get_cache_statistics():
+    """Size and hit/miss statistics of the vehicle, driver and user caches of this worker"""
+    return get_cache_stats()
+
+@router.get("/slow-queries", status_code=200)
+async def get_slow_query_samples():
+    """Most recent MongoDB commands of this worker which took longer than SLOW_QUERY_MS"""
+    return {"slow_queries": get_slow_queries()}
+
+@router.get("/pool", status_code=200)
+async def get_connection_pool_statistics(settings: Settings = Depends(get_settings)):
+    """Live MongoDB connection pool statistics of this worker per server: open and checked out connections, created
+    and closed counts and the time check outs waited for a connection"""
+    return {"max_pool_size": settings.MONGO_MAX_POOL_SIZE, "min_pool_size": settings.MONGO_MIN_POOL_SIZE,
+            "pools": get_pool_stats()}
+
+@router.post("/archive", status_code=200)
+async def archive_past_allocations(days: int | None = None, db = Depends(get_database)):
+    """Move allocations older than *days* days (default ARCHIVE_HORIZON_DAYS) to the monthly archive files. Reports
+    keep counting them through the allocation rollups"""
+    if days is not None and days < 1:
+        return {"message": "days should be positive"}
+    archived = await archive_allocations(db, days)
+    if archived is None:
+        return {"message": "Allocations are being archived by another worker, try again later"}
+    return {"message": "Allocations archived successfully", "archived": archived,
+            "months": await get_archived_months(db)}
@@ -1,42 +1,100 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
-from db.mongodb import MongoDB
+from pymongo.errors import DuplicateKeyError
+from core.config import Settings, get_settings
+from db.mongodb import get_database
 from models.vehicle import Driver
 from schemas.vehicle import DriverCreate
+from services.fast_json import fast_json_list
+from services.importer import get_import_format, import_documents
+from services.pairing import auto_pair_drivers
+from services.pagination import export_ndjson, get_page, validate_page_params
+from storage.base import Storage, get_storage
 
 router = APIRouter()
-database_instance = MongoDB()
 
 @router.get("/", status_code=200, response_model=list[Driver])
-async def get_drivers(page: int = 1, db = Depends(database_instance.get_database)):
+async def get_drivers(page: int = 1, storage: Storage = Depends(get_storage),
+                      settings: Settings = Depends(get_settings)):
     skip = 10 * (page - 1)
-    drivers = await db['drivers'].find().skip(skip).limit(10).to_list(10)
+    if settings.FAST_JSON_RESPONSES and storage.database is not None:
+        return await fast_json_list(storage.database['drivers'], Driver, skip, 10)
+    drivers = await storage.drivers.list(skip, 10)
     return drivers
 
+@router.get("/page", status_code=200)
+async def get_drivers_page(cursor: str | None = None, limit: int = 10, fields: str | None = None,
+                           db = Depends(get_database)):
+    """Get drivers page by page. Pass the *next_cursor* of a page as *cursor* to get the next one, *limit* is the page
+    size and *fields* a comma separated list of fields to return"""
+    message = validate_page_params(cursor, limit)
+    if message:
+        return {"message": message}
+    return await get_page(db['drivers'], cursor, limit, fields)
+
+@router.get("/export", status_code=200)
+async def export_drivers(fields: str | None = None, db = Depends(get_database)):
+    """Export all drivers as newline delimited json, streamed in batches"""
+    return StreamingResponse(export_ndjson(db['drivers'], fields), media_type="application/x-ndjson")
+
 @router.post("/add", status_code=201)
-async def add_driver(driver: DriverCreate, db = Depends(database_instance.get_database)):
+async def add_driver(driver: DriverCreate, storage: Storage = Depends(get_storage)):
     driver = driver.model_dump()
     # check if driver already exists with the same license number
     license_number = driver['license_number']
-    is_driver_exists = await db['drivers'].find_one({"license_number": license_number})
+    is_driver_exists = await storage.drivers.get_by_license_number(license_number)
     if is_driver_exists:
         return {"message": "Driver with this license number already exists"}
 
-    # create a new driver
-    result = db['drivers'].insert_one(driver)
+    # create a new driver, the unique index catches a concurrent insert of the same license number
+    try:
+        await storage.drivers.add(driver)
+    except DuplicateKeyError:
+        return {"message": "Driver with this license number already exists"}
     return {"message": "Driver added successfully"}
 
+@router.post("/import", status_code=200)
+async def import_drivers(request: Request, format: str | None = None, db = Depends(get_database)):
+    """Import drivers from a streamed csv (header row: name,license_number) or json lines upload, send the file as
+    request body. *format* is csv or jsonl, by default it follows the content type. Drivers whose license number
+    already exists are skipped, the report lists every row which was not imported"""
+    file_format = get_import_format(format, request.headers.get("content-type"))
+    if not file_format:
+        return {"message": "format should be csv or jsonl"}
+    return await import_documents(db, 'drivers', DriverCreate, 'license_number', request.stream(), file_format)
+
 @router.get("/unassign/{driver_id}", status_code=200)
-async def unassign_driver(driver_id:str, db = Depends(database_instance.get_database)):
+async def unassign_driver(driver_id:str, storage: Storage = Depends(get_storage)):
     # check if id is valid
     if not ObjectId.is_valid(driver_id):
         return {"message": "Invalid driver id"}
 
     # retrieve a driver by id
-    driver = await db['drivers'].find_one({"_id": ObjectId(driver_id)})
+    driver = await storage.drivers.get(ObjectId(driver_id))
     if not driver:
         return {"message": "Driver not found"}
 
     # unassign the driver from vehicle
-    result = await db['vehicles'].update_one({"driver": ObjectId(driver_id)}, {"$set": {"driver": None}})
+    await storage.vehicles.unassign_driver(ObjectId(driver_id))
     return {"message": "Driver unassigned successfully"}
+
+
+@router.post("/auto-pair", status_code=200)
+async def auto_pair_drivers_to_vehicles(body: dict, db = Depends(get_database)):
+    """Assign every free driver to a vehicle without driver in one go. Optional body fields: *preferences*, a list of
+    {"driver_id", "vehicle_id"} pairs tried first, *limit*, the maximum number of pairs and *dry_run* to only get the
+    pairs. Pairs which collide with a concurrent change are reported as conflicts"""
+    preferences = []
+    for preference in body.get('preferences') or []:
+        driver_id = preference.get('driver_id') if isinstance(preference, dict) else None
+        vehicle_id = preference.get('vehicle_id') if isinstance(preference, dict) else None
+        if not ObjectId.is_valid(driver_id) or not ObjectId.is_valid(vehicle_id):
+            return {"message": "Invalid driver/vehicle id in preferences"}
+        preferences.append((ObjectId(driver_id), ObjectId(vehicle_id)))
+
+    limit = body.get('limit') or 0
+    if not isinstance(limit, int) or limit < 0:
+        return {"message": "limit should be a positive number"}
+
+    return await auto_pair_drivers(db, preferences, limit, dry_run=bool(body.get('dry_run')))
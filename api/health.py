@@ -0,0 +1,30 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+from pymongo.errors import PyMongoError
+from db.indexes import get_missing_unique_indexes
+
+router = APIRouter()
+
+@router.get("/live", status_code=200)
+async def liveness():
+    """The process is up and serving requests"""
+    return {"status": "alive"}
+
+@router.get("/ready", status_code=200)
+async def readiness(request: Request):
+    """The storage answers a ping and, on MongoDB, all unique indexes exist. Return 503 otherwise so the worker gets no
+    traffic, without the date_vehicle index a vehicle could be booked twice on a day"""
+    storage = request.app.state.storage
+    if storage is None:
+        return JSONResponse(status_code=503, content={"status": "not ready", "message": "Database not connected"})
+    try:
+        ping = await storage.ping()
+        missing = await get_missing_unique_indexes(storage.database) if storage.database is not None else []
+    except PyMongoError as error:
+        return JSONResponse(status_code=503, content={"status": "not ready", "message": str(error)})
+    if missing:
+        return JSONResponse(status_code=503, content={
+            "status": "not ready", "message": "Unique indexes missing, run `python -m db.indexes --dedupe`",
+            "missing_unique_indexes": missing,
+        })
+    return {"status": "ready", "ping_ms": round(ping, 2)}
@@ -1,51 +1,106 @@
 from datetime import datetime, timedelta
 from fastapi import APIRouter, Depends, Request
 from bson import ObjectId
-from db.mongodb import MongoDB
+from services.rollup import USER, VEHICLE
+from services.service import ALLOCATION_DATE_FORMAT
+from storage.base import Storage, get_storage
 
 router = APIRouter()
-database_instance = MongoDB()
+
+# number of days a report covers when *days* is not given
+DEFAULT_REPORT_DAYS = 7
+
+
+def get_report_period(request: Request, default_days: int = DEFAULT_REPORT_DAYS) -> tuple:
+    """Return (start, end) of the last *days* days as YYYY-MM-DD strings, days is read from the query params"""
+    number_of_days = dict(request.query_params).get('days', default_days)
+    current_date = datetime.now().date()
+    query_date = current_date - timedelta(days=int(number_of_days))
+    return query_date.strftime(ALLOCATION_DATE_FORMAT), current_date.strftime(ALLOCATION_DATE_FORMAT)
+
 
 @router.get("/vehicle/{vehicle_id}/", status_code=200)
-async def get_vehicles_allocation_report(vehicle_id: str, request: Request, db = Depends(database_instance.get_database)):
+async def get_vehicles_allocation_report(vehicle_id: str, request: Request, storage: Storage = Depends(get_storage)):
     """Get vehicle allocation report by vehicle id and number of days, number of days pass in query params as *days*. It return
     in last x number of days how many times vehicle is allocated user"""
     if not ObjectId.is_valid(vehicle_id):
         return {"message": "Invalid vehicle id"}
 
-    query_params = dict(request.query_params)
-    number_of_days = query_params.get('days', 7)
-
-    current_date = datetime.now().date()
-    query_date = current_date - timedelta(days=int(number_of_days))
-
-    vehicle_allocation = await db["allocation"].count_documents({"vehicle": ObjectId(vehicle_id), "date": {
-            "$gte": query_date.strftime("%Y-%m-%d"),
-            "$lte": current_date.strftime("%Y-%m-%d")
-        }})
+    start, end = get_report_period(request)
+    vehicle_allocation = await storage.allocations.count(VEHICLE, ObjectId(vehicle_id), start, end)
 
     return {"allocation": vehicle_allocation}
 
 
 @router.get("/user/{user_id}/", status_code=200)
-async def get_vehicles_allocation_report(user_id: str, request: Request, db = Depends(database_instance.get_database)):
+async def get_users_allocation_report(user_id: str, request: Request, storage: Storage = Depends(get_storage)):
     """Get user allocation report by user id and number of days, number of days pass in query params as *days*. It return
     in last x number of days how many times user is allocated a vehicle"""
     if not ObjectId.is_valid(user_id):
         return {"message": "Invalid vehicle id"}
 
-    query_params = dict(request.query_params)
-    number_of_days = query_params.get('days', 7)
+    start, end = get_report_period(request)
+    user_allocation = await storage.allocations.count(USER, ObjectId(user_id), start, end)
+
+    return {"allocation": user_allocation}
+
+
+@router.get("/utilization/", status_code=200)
+async def get_fleet_utilization(request: Request, period: str = "day", storage: Storage = Depends(get_storage)):
+    """Fleet utilization of the last x number of days (*days* in query params, default 30) grouped by *period*: day, week
+    or month. Utilization of a bucket is allocations / (vehicles * days in the bucket)"""
+    if period not in ("day", "week", "month"):
+        return {"message": "period should be day, week or month"}
+
+    start, end = get_report_period(request, default_days=30)
+    allocations_per_day = await storage.allocations.daily_counts(start, end)
+    vehicles = await storage.vehicles.count()
+
+    buckets = {}
+    day = datetime.strptime(start, ALLOCATION_DATE_FORMAT).date()
+    last_day = datetime.strptime(end, ALLOCATION_DATE_FORMAT).date()
+    while day <= last_day:
+        if period == "day":
+            bucket = day.strftime(ALLOCATION_DATE_FORMAT)
+        elif period == "week":
+            bucket = (day - timedelta(days=day.weekday())).strftime(ALLOCATION_DATE_FORMAT)
+        else:
+            bucket = day.strftime("%Y-%m")
+        bucket = buckets.setdefault(bucket, {"period": bucket, "days": 0, "allocations": 0})
+        bucket['days'] += 1
+        bucket['allocations'] += allocations_per_day.get(day.strftime(ALLOCATION_DATE_FORMAT), 0)
+        day += timedelta(days=1)
+
+    for bucket in buckets.values():
+        capacity = vehicles * bucket['days']
+        bucket['utilization'] = round(bucket['allocations'] / capacity, 4) if capacity else 0
+
+    return {"vehicles": vehicles, "utilization": list(buckets.values())}
+
+
+@router.get("/top/{kind}/", status_code=200)
+async def get_top_allocated(kind: str, request: Request, limit: int = 10,
+                            storage: Storage = Depends(get_storage)):
+    """Top *limit* vehicles or users (kind: vehicles/users) by number of allocations in the last x number of days"""
+    kinds = {"vehicles": VEHICLE, "users": USER}
+    if kind not in kinds:
+        return {"message": "kind should be vehicles or users"}
+    if limit < 1:
+        return {"message": "limit should be positive"}
+
+    start, end = get_report_period(request)
+    top = await storage.allocations.top(kinds[kind], start, end, limit)
+
+    return {kind: [{"id": str(item['key']), "allocation": item['count']} for item in top]}
 
-    current_date = datetime.now().date()
-    query_date = current_date - timedelta(days=int(number_of_days))
 
-    vehicle_allocation = await db["allocation"].count_documents({
-        "user": ObjectId(user_id),
-        "date": {
-            "$gte": query_date.strftime("%Y-%m-%d"),
-            "$lte": current_date.strftime("%Y-%m-%d")
-        }
-    })
+@router.get("/idle-vehicles/", status_code=200)
+async def get_idle_vehicles(request: Request, storage: Storage = Depends(get_storage)):
+    """Vehicles which are not allocated at all in the last x number of days"""
+    start, end = get_report_period(request)
+    allocated_vehicles = await storage.allocations.keys(VEHICLE, start, end)
 
-    return {"allocation": vehicle_allocation}
\ No newline at end of file
+    vehicles = await storage.vehicles.find(exclude=allocated_vehicles, fields=["registration_number"])
+    idle = [{"id": str(vehicle['_id']), "registration_number": vehicle.get('registration_number')}
+            for vehicle in vehicles]
+    return {"idle_vehicles": idle}
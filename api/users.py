@@ -1,34 +1,41 @@
 from fastapi import APIRouter, Depends, HTTPException
 from bson import ObjectId
-from db.mongodb import MongoDB
+from pymongo.errors import DuplicateKeyError
 from schemas.user import UserCreate, UserResponse
 from models.users import User
-from services.service import hash_password
+from services.service import PasswordHasher, PasswordHashingBusy, get_password_hasher
+from storage.base import Storage, get_storage
 
 router = APIRouter()
-database_instance = MongoDB()
 
 @router.get("/{id}", status_code=200, response_model=UserResponse)
-async def get_user(id: str, db = Depends(database_instance.get_database)):
-    """Get a user by id. If not found return 404"""
-    user = await db['users'].find_one({"_id": ObjectId(id)})
+async def get_user(id: str, storage: Storage = Depends(get_storage)):
+    """Get a user by id. If the id is invalid or not found return 404"""
+    user = await storage.users.get(ObjectId(id)) if ObjectId.is_valid(id) else None
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return {"user": user}
+    return user
 
 @router.post("/create", status_code=201, response_model=UserResponse)
-async def create_user(user: UserCreate, db = Depends(database_instance.get_database)):
+async def create_user(user: UserCreate, storage: Storage = Depends(get_storage),
+                      hasher: PasswordHasher = Depends(get_password_hasher)):
     """Create a new user. Check before creating if user already exist if not then create a new user"""
+    # check if user already exist, before spending time on hashing the password
+    is_user_exist = await storage.users.get_by_email(user.email)
+    if is_user_exist:
+        raise HTTPException(status_code=400, detail="User already exist")
+
     # prepare user data
-    user.password = hash_password(user.password)
+    try:
+        user.password = await hasher.hash(user.password)
+    except PasswordHashingBusy:
+        raise HTTPException(status_code=503, detail="Too many signups at the moment, please try again")
     user_data = User(name=user.name, email=user.email, password=user.password)
     user_data = user_data.model_dump()
 
-    # check if user already exist
-    is_user_exist = await db['users'].find_one({"email": user_data['email']})
-    if is_user_exist:
+    # create a new user, the unique index catches a concurrent signup with the same email
+    try:
+        await storage.users.add(user_data)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="User already exist")
-
-    # create a new user
-    result = await db['users'].insert_one(user_data)
     return user_data
\ No newline at end of file
@@ -1,23 +1,60 @@
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
-from db.mongodb import MongoDB
+from pymongo.errors import DuplicateKeyError
+from core.config import Settings, get_settings
+from db.mongodb import get_database
 from models.vehicle import Vehicle
 from schemas.vehicle import VehicleCreate
-from services.service import get_free_vehicle_on_given_day
+from services.allocation_queue import QUEUE_COLLECTION, enqueue_allocation
+from services.availability_hub import (
+    get_availability_snapshot, hub, publish_allocation_change, publish_allocation_changes
+)
+from services.fast_json import fast_json_list
+from services.importer import get_import_format, import_documents
+from services.pagination import export_ndjson, get_page, validate_page_params
+from services.service import (
+    ALLOCATION_DATE_FORMAT, allocate_vehicles, claim_free_vehicle_on_given_day, get_availability_matrix,
+    reserve_vehicle_on_given_day
+)
+from storage.base import Storage, get_storage
 
 router = APIRouter()
-database_instance = MongoDB()
+
+# maximum number of bookings accepted by one bulk allocation request
+BULK_ALLOCATION_LIMIT = 10000
+# maximum number of days of an availability calendar
+CALENDAR_DAYS_LIMIT = 366
 
 @router.get("/", status_code=200, response_model=list[Vehicle])
-async def get_vehicles(page: int = 1, db = Depends(database_instance.get_database)):
+async def get_vehicles(page: int = 1, storage: Storage = Depends(get_storage),
+                       settings: Settings = Depends(get_settings)):
     skip = 10 * (page - 1)
-    vehicles = await db['vehicles'].find().skip(skip).limit(10).to_list(10)
+    if settings.FAST_JSON_RESPONSES and storage.database is not None:
+        return await fast_json_list(storage.database['vehicles'], Vehicle, skip, 10)
+    vehicles = await storage.vehicles.list(skip, 10)
     return vehicles
 
+@router.get("/page", status_code=200)
+async def get_vehicles_page(cursor: str | None = None, limit: int = 10, fields: str | None = None,
+                            db = Depends(get_database)):
+    """Get vehicles page by page. Pass the *next_cursor* of a page as *cursor* to get the next one, *limit* is the page
+    size and *fields* a comma separated list of fields to return"""
+    message = validate_page_params(cursor, limit)
+    if message:
+        return {"message": message}
+    return await get_page(db['vehicles'], cursor, limit, fields)
+
+@router.get("/export", status_code=200)
+async def export_vehicles(fields: str | None = None, db = Depends(get_database)):
+    """Export all vehicles as newline delimited json, streamed in batches"""
+    return StreamingResponse(export_ndjson(db['vehicles'], fields), media_type="application/x-ndjson")
+
 @router.get("/{id}", status_code=200, response_model=Vehicle|dict)
-async def get_vehicle(id:str, db = Depends(database_instance.get_database)):
+async def get_vehicle(id:str, storage: Storage = Depends(get_storage)):
     """Get specific vehicle by vehicle id"""
 
     # check if id is valid
@@ -25,28 +62,41 @@ async def get_vehicle(id:str, db = Depends(database_instance.get_database)):
         return {"message": "Invalid vehicle id"}
 
     # retrieve a vehicle by id
-    vehicle = await db['vehicles'].find_one({"_id": ObjectId(id)})
+    vehicle = await storage.vehicles.get(ObjectId(id))
     if not vehicle:
         return {"message": "Vehicle not found"}
     return vehicle
 
 @router.post("/add", status_code=201)
-async def add_vehicle(vehicle: VehicleCreate, db = Depends(database_instance.get_database)):
+async def add_vehicle(vehicle: VehicleCreate, storage: Storage = Depends(get_storage)):
     """add/create a new vehicle by providing registration_number, model and driver id(Optional)"""
     vehicle = vehicle.model_dump()
     # check if vehicle already exists with the same registration number
     registration_number = vehicle['registration_number']
-    is_vehicle_exists = await db['vehicles'].find_one({"registration_number": registration_number})
+    is_vehicle_exists = await storage.vehicles.get_by_registration_number(registration_number)
     if is_vehicle_exists:
         return {"message": "Vehicle with this registration number already exists"}
 
-    # create a new vehicle
-    result = db['vehicles'].insert_one(vehicle)
+    # create a new vehicle, the unique index catches a concurrent insert of the same registration number
+    try:
+        await storage.vehicles.add(vehicle)
+    except DuplicateKeyError:
+        return {"message": "Vehicle with this registration number already exists"}
     return {"message": "Vehicle added successfully"}
 
+@router.post("/import", status_code=200)
+async def import_vehicles(request: Request, format: str | None = None, db = Depends(get_database)):
+    """Import vehicles from a streamed csv (header row: registration_number,model,driver) or json lines upload, send
+    the file as request body. *format* is csv or jsonl, by default it follows the content type. Vehicles whose
+    registration number already exists are skipped, the report lists every row which was not imported"""
+    file_format = get_import_format(format, request.headers.get("content-type"))
+    if not file_format:
+        return {"message": "format should be csv or jsonl"}
+    return await import_documents(db, 'vehicles', VehicleCreate, 'registration_number', request.stream(), file_format)
+
 # @router.get("/{driver_id}/{vehicle_id}", status_code=200)
 @router.put("/assign_driver", status_code=200)
-async def assign_driver_to_vehicle(body:dict, db = Depends(database_instance.get_database)):
+async def assign_driver_to_vehicle(body:dict, storage: Storage = Depends(get_storage)):
     """Assign a driver to a vehicle by providing driver_id and vehicle_id. It makes sure that vehicle is not already
     assigned to a driver and driver is free to assign"""
 
@@ -58,8 +108,8 @@ async def assign_driver_to_vehicle(body:dict, db = Depends(database_instance.get
         return {"message": "Invalid driver/vehicle id"}
 
     # looking for driver and vehicle with given id
-    driver = await db['drivers'].find_one({"_id": ObjectId(driver_id)})
-    vehicle = await db['vehicles'].find_one({"_id": ObjectId(vehicle_id)})
+    driver = await storage.drivers.get(ObjectId(driver_id))
+    vehicle = await storage.vehicles.get(ObjectId(vehicle_id))
 
     # if driver or vehicle not found return message
     if not driver or not vehicle:
@@ -70,47 +120,235 @@ async def assign_driver_to_vehicle(body:dict, db = Depends(database_instance.get
         return {"message": "Vehicle already assigned to a driver"}
 
     # check if driver is free to assign
-    is_driver_free = await db['vehicles'].count_documents({"driver": ObjectId(driver_id)})
-    if is_driver_free != 0:
+    assigned_vehicle = await storage.vehicles.get_by_driver(ObjectId(driver_id))
+    if assigned_vehicle:
         return {"message": "Driver is not free to assign"}
 
-    # assign driver to vehicle
-    db['vehicles'].update_one({"_id": ObjectId(vehicle_id)}, {"$set": {"driver": ObjectId(driver_id)}})
+    # assign driver to vehicle, only if it is still without a driver as the cached vehicle may be outdated
+    is_assigned = await storage.vehicles.assign_driver(ObjectId(vehicle_id), ObjectId(driver_id), vehicle.get('driver'))
+    if not is_assigned:
+        return {"message": "Vehicle already assigned to a driver"}
     return {"message": "Driver assigned to vehicle successfully"}
 
 
-@router.post("/allocate/user", status_code=200)
-async def allocate_vehicle_to_user(body:dict, db = Depends(database_instance.get_database)):
-    """Assign a vehicle to a user by providing user_id and vehicle_id. It makes sure that vehicle is not already
-    assigned to a user."""
+async def validate_allocation_request(body: dict, storage: Storage) -> tuple:
+    """Check date and user of an allocation request. Return (message, user_id, date), message is None if the request
+    is valid"""
 
     # Check if the allocation date is greater than today's date
     date = body.get('date')
     date = datetime.strptime(date, "%d-%m-%Y").date()
     if date <= datetime.now().date():
-        return {"message": "Allocation date should be tomorrow or later"}
+        return "Allocation date should be tomorrow or later", None, None
 
     # checking the validity of the user id
     user_id = body.get('user_id')
     if not ObjectId.is_valid(user_id):
-        return {"message": "Invalid data for user"}
+        return "Invalid data for user", None, None
 
     # looking for user with given id
-    user = await db['users'].count_documents({"_id": ObjectId(user_id)})
+    user = await storage.users.get(ObjectId(user_id))
     if not user:
-        return {"message": "User not found"}
+        return "User not found", None, None
+
+    return None, ObjectId(user_id), date
+
+@router.get("/availability/calendar", status_code=200)
+async def get_availability_calendar(start: str | None = None, days: int = 30,
+                                    storage: Storage = Depends(get_storage)):
+    """Which vehicles are free on each day of the *days* days starting at *start* (dd-mm-yyyy, default tomorrow).
+    *free* holds the number of free vehicles per day, *matrix* the status of every vehicle on every day as a zlib
+    compressed, base64 encoded bitset: one row of *days* bits per vehicle in the order of *vehicles*, bit
+    (vehicle * days + day) is set when the vehicle is allocated, most significant bit first."""
+    if start:
+        try:
+            start_date = datetime.strptime(start, "%d-%m-%Y").date()
+        except ValueError:
+            return {"message": "Invalid start date, format should be dd-mm-yyyy"}
+    else:
+        start_date = datetime.now().date() + timedelta(days=1)
+    if not 1 <= days <= CALENDAR_DAYS_LIMIT:
+        return {"message": f"days should be between 1 and {CALENDAR_DAYS_LIMIT}"}
+
+    calendar = await get_availability_matrix(start_date, days, storage)
+    return {"start": start_date.strftime("%d-%m-%Y"), "days": days, "encoding": "zlib+base64 bitset", **calendar}
+
+@router.websocket("/availability/ws")
+async def availability_updates(websocket: WebSocket, dates: str, storage: Storage = Depends(get_storage),
+                               settings: Settings = Depends(get_settings)):
+    """Live availability of the given dates (comma separated, dd-mm-yyyy). A snapshot
+    {"type": "snapshot", "date", "vehicles", "allocated", "free"} is sent for every date first, after that
+    {"type": "delta", "date", "allocated"} messages carry the net change of allocations of a date. A snapshot is sent
+    again whenever the client fell too far behind."""
+    try:
+        dates = {datetime.strptime(date.strip(), "%d-%m-%Y").strftime(ALLOCATION_DATE_FORMAT)
+                 for date in dates.split(",") if date.strip()}
+    except ValueError:
+        await websocket.close(code=1003, reason="Invalid date, format should be dd-mm-yyyy")
+        return
+    if not 1 <= len(dates) <= settings.AVAILABILITY_MAX_DATES:
+        await websocket.close(code=1003, reason=f"Subscribe to 1 to {settings.AVAILABILITY_MAX_DATES} dates")
+        return
+
+    await websocket.accept()
+    subscription = hub.subscribe(dates)
+
+    async def send_snapshot(date):
+        snapshot = await get_availability_snapshot(storage, date)
+        date = datetime.strptime(date, ALLOCATION_DATE_FORMAT).strftime("%d-%m-%Y")
+        await websocket.send_json({"type": "snapshot", "date": date, **snapshot})
+
+    async def send_updates():
+        for date in sorted(dates):
+            await send_snapshot(date)
+        while True:
+            changes, refresh = await subscription.next_updates()
+            for date in sorted(refresh):
+                await send_snapshot(date)
+            for date, allocated in sorted(changes.items()):
+                date = datetime.strptime(date, ALLOCATION_DATE_FORMAT).strftime("%d-%m-%Y")
+                await websocket.send_json({"type": "delta", "date": date, "allocated": allocated})
+
+    async def wait_for_disconnect():
+        while True:
+            await websocket.receive_text()
+
+    # stop sending as soon as the client goes away
+    tasks = [asyncio.create_task(send_updates()), asyncio.create_task(wait_for_disconnect())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        hub.unsubscribe(subscription)
+        for task in tasks:
+            task.cancel()
+    for task in done:
+        if task.exception() and not isinstance(task.exception(), WebSocketDisconnect):
+            raise task.exception()
 
-    available_vehicles = await get_free_vehicle_on_given_day(date, db)
-    if not available_vehicles:
+@router.post("/allocate/user", status_code=200)
+async def allocate_vehicle_to_user(body:dict, storage: Storage = Depends(get_storage)):
+    """Assign a vehicle to a user by providing user_id and vehicle_id. It makes sure that vehicle is not already
+    assigned to a user."""
+    message, user_id, date = await validate_allocation_request(body, storage)
+    if message:
+        return {"message": message}
+
+    # allocate a free vehicle to user, the unique (date, vehicle) key guarantees no vehicle is booked twice
+    allocation = await reserve_vehicle_on_given_day(user_id, date, storage)
+    if not allocation:
         return {"message": "No vehicle available for allocation"}
-    # allocate the vehicle to user
-    allocation = {"user":ObjectId(user_id), "vehicle":available_vehicles['_id'], "date":date.strftime("%Y-%m-%d")}
-    result = await db['allocation'].insert_one(allocation)
 
     return {"message": "User assigned to vehicle successfully"}
 
+@router.post("/allocate/user/async", status_code=202)
+async def queue_vehicle_allocation(body:dict, response: Response, storage: Storage = Depends(get_storage),
+                                   settings: Settings = Depends(get_settings)):
+    """Queue the allocation of a vehicle to a user (same body as /allocate/user) and return a request id right away.
+    The request is allocated in the background together with the other requests of the same date, its outcome is
+    available at /allocate/requests/{request_id}. When the queue is disabled or the storage is not MongoDB it is
+    allocated synchronously."""
+    if not settings.ALLOCATION_QUEUE_ENABLED or storage.database is None:
+        response.status_code = 200
+        return await allocate_vehicle_to_user(body, storage)
+
+    message, user_id, date = await validate_allocation_request(body, storage)
+    if message:
+        response.status_code = 200
+        return {"message": message}
+
+    request = await enqueue_allocation(storage.database, user_id, date)
+    return {"message": "Allocation request queued", "request_id": str(request['_id']), "status": request['status']}
+
+@router.get("/allocate/requests/{request_id}", status_code=200)
+async def get_allocation_request(request_id: str, db = Depends(get_database)):
+    """Status of a queued allocation request: pending, processing, allocated or failed"""
+    if not ObjectId.is_valid(request_id):
+        return {"message": "Invalid request id"}
+
+    request = await db[QUEUE_COLLECTION].find_one({"_id": ObjectId(request_id)})
+    if not request:
+        return {"message": "No allocation request found with this id"}
+
+    return {
+        "request_id": request_id,
+        "status": request['status'],
+        "user_id": str(request['user']),
+        "date": datetime.strptime(request['date'], ALLOCATION_DATE_FORMAT).strftime("%d-%m-%Y"),
+        "message": request.get('message'),
+        "allocation_id": str(request['allocation']) if request.get('allocation') else None,
+        "vehicle_id": str(request['vehicle']) if request.get('vehicle') else None,
+    }
+
+@router.post("/allocate/bulk", status_code=200)
+async def allocate_vehicles_to_users(body:dict, storage: Storage = Depends(get_storage)):
+    """Allocate vehicles for many bookings in one call. Body is either a list of bookings
+    {"allocations": [{"user_id": ..., "date": "dd-mm-yyyy"}, ...]} or one user and a date range
+    {"user_id": ..., "start_date": "dd-mm-yyyy", "end_date": "dd-mm-yyyy"}. Every booking follows the same rules as
+    /allocate/user and gets its own result in the response, in the order of the request."""
+
+    # collect the requested bookings as (user_id, date) pairs
+    if "allocations" in body:
+        items = body.get("allocations")
+        if not isinstance(items, list):
+            return {"message": "allocations should be a list"}
+        items = [(item.get('user_id'), item.get('date')) if isinstance(item, dict) else (None, None) for item in items]
+    elif "user_id" in body:
+        try:
+            start_date = datetime.strptime(body.get('start_date'), "%d-%m-%Y").date()
+            end_date = datetime.strptime(body.get('end_date'), "%d-%m-%Y").date()
+        except (TypeError, ValueError):
+            return {"message": "start_date and end_date are required, format should be dd-mm-yyyy"}
+        if end_date < start_date:
+            return {"message": "end_date should not be before start_date"}
+        if (end_date - start_date).days >= BULK_ALLOCATION_LIMIT:
+            return {"message": f"At most {BULK_ALLOCATION_LIMIT} bookings can be allocated at once"}
+        items = [(body.get('user_id'), (start_date + timedelta(days=day)).strftime("%d-%m-%Y"))
+                 for day in range((end_date - start_date).days + 1)]
+    else:
+        return {"message": "Provide allocations or user_id with start_date and end_date"}
+
+    if len(items) > BULK_ALLOCATION_LIMIT:
+        return {"message": f"At most {BULK_ALLOCATION_LIMIT} bookings can be allocated at once"}
+
+    results = [{"user_id": user_id, "date": date} for user_id, date in items]
+    today = datetime.now().date()
+    bookings = []
+    for result, (user_id, date) in zip(results, items):
+        try:
+            date = datetime.strptime(date, "%d-%m-%Y").date()
+        except (TypeError, ValueError):
+            result['message'] = "Invalid date, format should be dd-mm-yyyy"
+            continue
+        if date <= today:
+            result['message'] = "Allocation date should be tomorrow or later"
+            continue
+        if not isinstance(user_id, str) or not ObjectId.is_valid(user_id):
+            result['message'] = "Invalid data for user"
+            continue
+        bookings.append((result, ObjectId(user_id), date))
+
+    # validate all users with a single query
+    existing_users = await storage.users.existing_ids(list({user_id for _, user_id, _ in bookings}))
+    for result, user_id, _ in bookings:
+        if user_id not in existing_users:
+            result['message'] = "User not found"
+    bookings = [booking for booking in bookings if booking[1] in existing_users]
+
+    allocations = await allocate_vehicles([(user_id, date) for _, user_id, date in bookings], storage)
+    for (result, _, _), allocation in zip(bookings, allocations):
+        if allocation:
+            result.update({"allocation_id": str(allocation['_id']), "vehicle_id": str(allocation['vehicle']),
+                           "message": "User assigned to vehicle successfully"})
+        else:
+            result['message'] = "No vehicle available for allocation"
+
+    for result in results:
+        result['allocated'] = "allocation_id" in result
+    allocated = sum(result['allocated'] for result in results)
+    return {"allocated": allocated, "failed": len(results) - allocated, "results": results}
+
 @router.get("/allocate_update/{allocate_id}/", status_code=200)
-async def update_allocation(allocate_id: str, request:Request, db = Depends(database_instance.get_database)):
+async def update_allocation(allocate_id: str, request:Request, storage: Storage = Depends(get_storage)):
     """Update allocation date, vehicle of a previous allocation by allocation id
      query_params: date, vehicle_id date format should be dd-mm-yyyy
     """
@@ -118,7 +356,7 @@ async def update_allocation(allocate_id: str, request:Request, db = Depends(data
         return {"message": "Invalid allocation id"}
 
     # check that is proivde a valid allocation id
-    allocation = await db['allocation'].find_one({"_id": ObjectId(allocate_id)})
+    allocation = await storage.allocations.get(ObjectId(allocate_id))
     if not allocation:
         return {"message": "No allocation found with this id"}
 
@@ -131,25 +369,38 @@ async def update_allocation(allocate_id: str, request:Request, db = Depends(data
         date = datetime.strptime(date, "%d-%m-%Y").date()
         if date <= datetime.now().date():
             return {"message": "Allocation date should be tomorrow or later"}
-        update_set['date'] = date.strftime("%Y-%m-%d")
+        update_set['date'] = date.strftime(ALLOCATION_DATE_FORMAT)
 
     if "vehicle" in query_params:
-        # if vehicle exist in query_params then allocate a new vehicle
-        vehicle = query_params.get('vehicle')
-        date = datetime.strptime(allocation.get('date'), "%Y-%m-%d").date()
-        available_vehicle = await get_free_vehicle_on_given_day(date, db)
+        # if vehicle exist in query_params then allocate a new vehicle on the (new) allocation date
+        date = datetime.strptime(update_set.get('date', allocation.get('date')), ALLOCATION_DATE_FORMAT).date()
+
+        async def claim(vehicle_id):
+            update_set['vehicle'] = vehicle_id
+            if not await storage.allocations.update(allocation, update_set):
+                raise HTTPException(status_code=404, detail="No allocation found with this id")
+
+        available_vehicle = await claim_free_vehicle_on_given_day(date, storage, claim)
         if not available_vehicle:
             return {"message": "No vehicle available for allocation"}
-        update_set['vehicle'] = ObjectId(available_vehicle['_id'])
+        publish_allocation_change(allocation, {**allocation, **update_set})
+        return {"message": "Allocation updated successfully"}
 
     if update_set:
-        db['allocation'].update_one({"_id": ObjectId(allocate_id)}, {"$set": update_set})
+        try:
+            updated = await storage.allocations.update(allocation, update_set)
+        except DuplicateKeyError:
+            return {"message": "Vehicle is already allocated on this date"}
+        # deleted since it was read
+        if not updated:
+            raise HTTPException(status_code=404, detail="No allocation found with this id")
+        publish_allocation_change(allocation, {**allocation, **update_set})
     return {"message": "Allocation updated successfully"}
 
 
 """ This api not properly tested. There may be a issues"""
 # @router.delete("/allocate/delete/", status_code=200)
-# async def cancel_allocation(request: Request, db = Depends(database_instance.get_database)):
+# async def cancel_allocation(request: Request, db = Depends(get_database)):
 #     """Cancel allocation of user or vehicle on a specefic date.
 #     query_params: user_id or vehicle_id and date. date format should be dd-mm-yyyy"""
 #     query_params = dict(request.query_params)
@@ -186,22 +437,23 @@ async def update_allocation(allocate_id: str, request:Request, db = Depends(data
 #     return {"message": "Allocation cancelled successfully"}
 
 @router.delete("/allocate/delete/{allocate_id}/", status_code=200)
-async def cancel_allocation_by_id(allocate_id: str, db = Depends(database_instance.get_database)):
+async def cancel_allocation_by_id(allocate_id: str, storage: Storage = Depends(get_storage)):
     """Cancel allocation based on allocation id"""
     if not ObjectId.is_valid(allocate_id):
         return {"message": "Invalid allocation id"}
 
     # check if any allocation exists with given id
-    allocation = await db['allocation'].find_one({"_id": ObjectId(allocate_id)})
+    allocation = await storage.allocations.get(ObjectId(allocate_id))
     if not allocation:
         return {"message": "No allocation found with this id"}
 
     # check if allocation date is passed or not
-    allocation_date = allocation.get('date').date()
+    allocation_date = datetime.strptime(allocation.get('date'), ALLOCATION_DATE_FORMAT).date()
     if allocation_date <= datetime.now().date():
         return {"message": "You can't cancel this allocation. Last time to cancel is over"}
     # delete/cancel allocatioin
-    result = await db['allocation'].delete_one({"_id": ObjectId(allocate_id)})
+    if await storage.allocations.delete(allocation):
+        publish_allocation_changes([allocation], amount=-1)
 
     return {"message": "Allocation cancelled successfully"}
 
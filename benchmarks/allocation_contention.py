@@ -0,0 +1,68 @@
+"""Concurrency stress test for vehicle allocation. It fires a few hundred concurrent reservations for the same day
+against a small fleet and then verifies that no vehicle was booked twice and that every vehicle was handed out as long
+as there were requests left for it.
+
+Usage: DATABASE_URL=mongodb://localhost:27017 python -m benchmarks.allocation_contention [--requests 300] [--vehicles 50]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+os.environ.setdefault("DATABASE_URL", "mongodb://localhost:27017")
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from services.service import ALLOCATION_DATE_FORMAT, ensure_allocation_indexes, reserve_vehicle_on_given_day
+from storage.mongo import MongoStorage
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--vehicles", type=int, default=50)
+    parser.add_argument("--database", default="bench_allocation_contention")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ.get("DATABASE_URL", "mongodb://localhost:27017"), maxPoolSize=args.requests)
+    await client.drop_database(args.database)
+    db = client.get_database(args.database)
+    await ensure_allocation_indexes(db)
+    await db['vehicles'].insert_many(
+        [{"registration_number": f"BENCH-{i}", "model": "bench", "driver": None} for i in range(args.vehicles)]
+    )
+    day = date.today() + timedelta(days=1)
+
+    started = time.perf_counter()
+    storage = MongoStorage(db)
+    results = await asyncio.gather(*[reserve_vehicle_on_given_day(ObjectId(), day, storage)
+                                     for _ in range(args.requests)])
+    elapsed = time.perf_counter() - started
+
+    allocated = [result for result in results if result]
+    double_booked = await db['allocation'].aggregate([
+        {"$match": {"date": day.strftime(ALLOCATION_DATE_FORMAT)}},
+        {"$group": {"_id": "$vehicle", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]).to_list(None)
+    stored = await db['allocation'].count_documents({})
+
+    print(f"requests: {args.requests}, vehicles: {args.vehicles}, elapsed: {elapsed:.2f}s "
+          f"({args.requests / elapsed:.0f} req/s)")
+    print(f"allocated: {len(allocated)}, stored: {stored}, double booked vehicles: {len(double_booked)}")
+
+    await client.drop_database(args.database)
+    client.close()
+
+    expected = min(args.requests, args.vehicles)
+    if double_booked or stored != len(allocated) or len(allocated) != expected:
+        print(f"FAILED: expected {expected} allocations and no double booking")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
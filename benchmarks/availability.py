@@ -0,0 +1,92 @@
+"""Benchmark for get_free_vehicle_on_given_day. It seeds a fleet and a growing allocation history into a scratch
+database and measures the lookup latency at every size, latency should stay flat as the history grows. With
+--backend memory it runs on the in-memory storage instead, no MongoDB needed.
+
+Usage: DATABASE_URL=mongodb://localhost:27017 python -m benchmarks.availability [--vehicles 200] [--sizes 1000,10000,100000]
+       python -m benchmarks.availability --backend memory
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+os.environ.setdefault("DATABASE_URL", "mongodb://localhost:27017")
+
+from services.service import ALLOCATION_DATE_FORMAT, ensure_allocation_indexes, get_free_vehicle_on_given_day
+from storage.memory import MemoryStorage
+
+
+async def seed(storage, vehicles: int, allocations: int, start: date):
+    """Create *vehicles* vehicles and spread *allocations* allocations over the days before *start* in an empty
+    storage"""
+    fleet = [{"registration_number": f"BENCH-{i}", "model": "bench", "driver": None} for i in range(vehicles)]
+    await storage.vehicles.add_many(fleet)
+    vehicle_ids = [vehicle['_id'] for vehicle in fleet]
+    days = max(1, allocations // vehicles)
+
+    batch = []
+    for i in range(allocations):
+        day = start - timedelta(days=1 + i % days)
+        batch.append({"user": None, "vehicle": vehicle_ids[(i // days) % vehicles], "date": day.strftime(ALLOCATION_DATE_FORMAT)})
+        if len(batch) == 10000:
+            await storage.allocations.add_many(batch)
+            batch = []
+    if batch:
+        await storage.allocations.add_many(batch)
+
+    # book most of the fleet on the benchmarked day so the lookup has to skip busy vehicles
+    busy = random.sample(vehicle_ids, k=int(vehicles * 0.9))
+    await storage.allocations.add_many(
+        [{"user": None, "vehicle": vehicle_id, "date": start.strftime(ALLOCATION_DATE_FORMAT)} for vehicle_id in busy]
+    )
+
+
+async def measure(storage, day: date, rounds: int) -> list[float]:
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await get_free_vehicle_on_given_day(day, storage)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vehicles", type=int, default=200)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--database", default="bench_availability")
+    parser.add_argument("--backend", choices=["mongo", "memory"], default="mongo")
+    args = parser.parse_args()
+
+    if args.backend == "mongo":
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from storage.mongo import MongoStorage
+
+        client = AsyncIOMotorClient(os.environ["DATABASE_URL"])
+        db = client.get_database(args.database)
+    day = date.today() + timedelta(days=1)
+
+    print(f"{'allocations':>12} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        if args.backend == "mongo":
+            await client.drop_database(args.database)
+            await ensure_allocation_indexes(db)
+            storage = MongoStorage(db)
+        else:
+            storage = MemoryStorage()
+        await seed(storage, args.vehicles, size, day)
+        timings = sorted(await measure(storage, day, args.rounds))
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        print(f"{size:>12} {statistics.median(timings):>8.2f} {p95:>8.2f} {timings[-1]:>8.2f}")
+
+    if args.backend == "mongo":
+        await client.drop_database(args.database)
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,227 @@
+"""Load test of the API. It boots the FastAPI app of main.py in-process against a scratch database, seeds a fleet, users
+and an allocation history, drives traffic at a target concurrency and reports throughput and p50/p95/p99 latency per
+route. Results can be written as json and compared with a previous run to catch regressions.
+
+With --backend memory the app runs on the in-memory storage and needs no MongoDB, the scenarios then leave out the
+MongoDB only /page route.
+
+Traffic is either synthesized from a scenario or replayed from a jsonl file with one request per line:
+{"method": "GET", "path": "/api/vehicles/", "json": null}
+
+Usage:
+    DATABASE_URL=mongodb://localhost:27017 python -m benchmarks.loadtest --scenario mixed --concurrency 32
+    python -m benchmarks.loadtest --scenario report --history 10000,100000 --output report.json --compare baseline.json
+    python -m benchmarks.loadtest --backend memory --scenario allocate
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+from datetime import date, timedelta
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--scenario", choices=["read", "allocate", "report", "mixed"], default="mixed")
+parser.add_argument("--replay", help="jsonl file of requests to replay instead of a scenario")
+parser.add_argument("--concurrency", type=int, default=16)
+parser.add_argument("--requests", type=int, default=2000, help="requests per run")
+parser.add_argument("--vehicles", type=int, default=200)
+parser.add_argument("--users", type=int, default=1000)
+parser.add_argument("--history", default="10000", help="comma separated allocation history sizes, one run per size")
+parser.add_argument("--database", default="bench_loadtest")
+parser.add_argument("--backend", choices=["mongo", "memory"], default="mongo", help="storage backend of the app")
+parser.add_argument("--output", help="write the results as json to this file")
+parser.add_argument("--compare", help="json results of a previous run to compare p95 latency with")
+parser.add_argument("--threshold", type=float, default=20, help="p95 regression in percent reported as failure")
+args = parser.parse_args()
+
+# point the app to the scratch database before its settings are read
+os.environ.setdefault("DATABASE_URL", "mongodb://localhost:27017")
+os.environ["DATABASE_NAME"] = args.database
+os.environ["STORAGE_BACKEND"] = args.backend
+
+import httpx
+
+from main import create_app
+from services.service import ALLOCATION_DATE_FORMAT, hash_password
+from storage.memory import MemoryStorage
+
+OBJECT_ID = re.compile(r"/[0-9a-f]{24}(?=/|$)")
+
+
+async def add_all(repository, documents: list) -> list:
+    await repository.add_many(documents)
+    return [document['_id'] for document in documents]
+
+
+async def seed(storage, vehicles: int, users: int, history: int) -> dict:
+    """Fill the empty storage and return the ids requests are generated from"""
+    drivers = await add_all(storage.drivers,
+                            [{"name": f"Driver {i}", "license_number": f"BENCH-L-{i}"} for i in range(vehicles)])
+    vehicle_ids = await add_all(storage.vehicles, [{"registration_number": f"BENCH-{i}", "model": "bench",
+                                                    "driver": drivers[i]} for i in range(vehicles)])
+    password = hash_password("bench-password")
+    user_ids = await add_all(storage.users, [{"name": f"User {i}", "email": f"user{i}@bench.example.com",
+                                              "password": password} for i in range(users)])
+
+    # past allocations, at most one per vehicle and day
+    today = date.today()
+    batch = []
+    for i in range(history):
+        day = today - timedelta(days=i // vehicles)
+        batch.append({"user": random.choice(user_ids), "vehicle": vehicle_ids[i % vehicles],
+                      "date": day.strftime(ALLOCATION_DATE_FORMAT)})
+        if len(batch) == 10000:
+            await storage.allocations.add_many(batch)
+            batch = []
+    if batch:
+        await storage.allocations.add_many(batch)
+    return {"vehicles": vehicle_ids, "users": user_ids, "drivers": drivers}
+
+
+def future_date() -> str:
+    return (date.today() + timedelta(days=random.randint(1, 60))).strftime("%d-%m-%Y")
+
+
+def scenario_requests(scenario: str, ids: dict):
+    """Endless generator of (method, path, json) for a scenario"""
+    vehicle = lambda: str(random.choice(ids['vehicles']))
+    user = lambda: str(random.choice(ids['users']))
+    read = [
+        lambda: ("GET", f"/api/vehicles/{vehicle()}", None),
+        lambda: ("GET", "/api/vehicles/", None),
+        lambda: ("GET", "/api/drivers/", None),
+        lambda: ("GET", f"/api/user/{user()}", None),
+    ]
+    if args.backend == "mongo":
+        read.append(lambda: ("GET", "/api/vehicles/page?limit=50", None))
+    allocate = [
+        lambda: ("POST", "/api/vehicles/allocate/user", {"user_id": user(), "date": future_date()}),
+    ]
+    report = [
+        lambda: ("GET", f"/api/report/vehicle/{vehicle()}/?days=30", None),
+        lambda: ("GET", f"/api/report/user/{user()}/?days=30", None),
+        lambda: ("GET", "/api/report/utilization/?days=90&period=week", None),
+        lambda: ("GET", "/api/report/top/users/?days=30", None),
+        lambda: ("GET", "/api/report/idle-vehicles/?days=7", None),
+    ]
+    generators = {"read": read, "allocate": allocate, "report": report, "mixed": read * 4 + allocate * 2 + report}
+    while True:
+        yield random.choice(generators[scenario])()
+
+
+def replay_requests(path: str):
+    """Endless generator of (method, path, json) replaying a jsonl file"""
+    with open(path) as file:
+        requests = [json.loads(line) for line in file if line.strip()]
+    requests = [(request['method'], request['path'], request.get('json')) for request in requests
+                if isinstance(request, dict) and 'method' in request and 'path' in request]
+    if not requests:
+        sys.exit(f"{path} does not contain any request with method and path")
+    while True:
+        yield from requests
+
+
+def percentile(timings: list, percent: float) -> float:
+    return timings[min(len(timings) - 1, max(0, int(round(len(timings) * percent / 100)) - 1))]
+
+
+async def run(client, requests, total: int, concurrency: int) -> dict:
+    """Send *total* requests with *concurrency* workers, return latency statistics per route"""
+    timings = {}
+    errors = {}
+    remaining = total
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            method, path, body = next(requests)
+            route = f"{method} {OBJECT_ID.sub('/{id}', path.split('?')[0])}"
+            started = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            timings.setdefault(route, []).append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                errors[route] = errors.get(route, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    routes = {}
+    for route, route_timings in sorted(timings.items()):
+        route_timings.sort()
+        routes[route] = {
+            "count": len(route_timings),
+            "errors": errors.get(route, 0),
+            "throughput": round(len(route_timings) / elapsed, 1),
+            "p50": round(percentile(route_timings, 50), 2),
+            "p95": round(percentile(route_timings, 95), 2),
+            "p99": round(percentile(route_timings, 99), 2),
+        }
+    return {"elapsed": round(elapsed, 2), "throughput": round(total / elapsed, 1), "routes": routes}
+
+
+def print_run(result: dict):
+    print(f"  {result['throughput']} req/s in {result['elapsed']}s")
+    print(f"  {'route':<48} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, stats in result['routes'].items():
+        print(f"  {route:<48} {stats['count']:>6} {stats['errors']:>6} {stats['p50']:>8} {stats['p95']:>8} "
+              f"{stats['p99']:>8}")
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return the (run, route, baseline p95, p95) whose p95 got worse than *threshold* percent"""
+    regressions = []
+    for name, result in results['runs'].items():
+        for route, stats in result['routes'].items():
+            previous = baseline.get('runs', {}).get(name, {}).get('routes', {}).get(route)
+            if previous and stats['p95'] > previous['p95'] * (1 + threshold / 100):
+                regressions.append((name, route, previous['p95'], stats['p95']))
+    return regressions
+
+
+async def main():
+    results = {"scenario": args.replay or args.scenario, "backend": args.backend, "concurrency": args.concurrency,
+               "runs": {}}
+    app = create_app()
+    # one log line per request would bury the results and slow the run down
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    async with app.router.lifespan_context(app):
+        # unhandled exceptions are answered with 500 and counted as errors of their route instead of ending the run
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+            for history in [int(size) for size in args.history.split(",")]:
+                if args.backend == "memory":
+                    app.state.storage = MemoryStorage()
+                else:
+                    for collection in ("vehicles", "drivers", "users", "allocation", "allocation_rollup"):
+                        await app.state.storage.database[collection].delete_many({})
+                ids = await seed(app.state.storage, args.vehicles, args.users, history)
+                requests = replay_requests(args.replay) if args.replay else scenario_requests(args.scenario, ids)
+                name = f"history={history}"
+                print(f"{results['scenario']} {args.backend} {name} vehicles={args.vehicles} users={args.users}")
+                results['runs'][name] = await run(client, requests, args.requests, args.concurrency)
+                print_run(results['runs'][name])
+        if args.backend == "mongo":
+            await app.state.mongodb.client.drop_database(args.database)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for name, route, previous, current in regressions:
+            print(f"REGRESSION {name} {route}: p95 {previous} ms -> {current} ms")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
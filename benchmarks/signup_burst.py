@@ -0,0 +1,75 @@
+"""Event loop lag during a burst of signups. It hashes a burst of passwords the way create_user does, once inline on
+the event loop (the old behaviour) and once through the password hasher of the application, while `GET /` is requested
+in a loop with a short sleep in between. The lag of a round is the latency of `GET /` plus how late the loop woke up
+from the sleep, with the pool it stays flat during the burst.
+
+No database is needed, `GET /` does not touch it.
+
+Usage: python -m benchmarks.signup_burst [--signups 50]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import time
+
+os.environ.setdefault("DATABASE_URL", "mongodb://localhost:27017")
+
+import httpx
+
+from main import create_app
+from services.service import hash_password
+
+
+PROBE_INTERVAL = 0.005
+
+
+async def probe(client, stop: asyncio.Event) -> list[float]:
+    """Request GET / and sleep PROBE_INTERVAL until stopped. Return the lag of every round in ms, the time the request
+    took plus how late the event loop woke up from the sleep, a loop blocked by hashing shows up in the latter"""
+    timings = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        await client.get("/")
+        await asyncio.sleep(PROBE_INTERVAL)
+        timings.append((time.perf_counter() - started - PROBE_INTERVAL) * 1000)
+    return timings
+
+
+async def inline_signup(password):
+    return hash_password(password)
+
+
+async def run(client, signup, signups: int) -> list[float]:
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(client, stop))
+    await asyncio.sleep(0.05)
+    await asyncio.gather(*[signup(f"password-{i}") for i in range(signups)])
+    stop.set()
+    return await prober
+
+
+def summary(name: str, timings: list[float]):
+    timings = sorted(timings)
+    p99 = timings[max(0, int(len(timings) * 0.99) - 1)]
+    print(f"{name:<8} {len(timings):>8} {statistics.median(timings):>8.2f} {p99:>8.2f} {timings[-1]:>8.2f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--signups", type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app()
+    # one log line per probe would bury the results
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        print(f"{'mode':<8} {'probes':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}  (lag per round)")
+        summary("inline", await run(client, inline_signup, args.signups))
+        summary("pool", await run(client, app.state.hasher.hash, args.signups))
+    app.state.hasher.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
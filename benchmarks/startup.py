@@ -0,0 +1,107 @@
+"""Cold start of a worker. Measured in fresh interpreters so nothing is cached from an earlier import:
+- import time of `main` from `python -X importtime`, with the modules which take longest
+- time to first response: create_app() and one `GET /health/live` through an in-process transport
+
+No database is needed, the app is not started and /health/live does not touch it. With --max-import-ms and
+--max-first-response-ms the script exits with 1 when a threshold is exceeded, so it can guard against regressions in CI.
+
+Usage: python -m benchmarks.startup [--runs 5] [--max-import-ms 300] [--max-first-response-ms 1500] [--output file]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+FIRST_RESPONSE = """
+import asyncio, time
+started = time.perf_counter()
+import httpx
+from main import create_app
+
+async def first_response():
+    app = create_app()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        response = await client.get("/health/live")
+    assert response.status_code == 200, response.status_code
+
+asyncio.run(first_response())
+print((time.perf_counter() - started) * 1000)
+"""
+
+
+def python(*args) -> subprocess.CompletedProcess:
+    env = {**os.environ, "DATABASE_URL": os.environ.get("DATABASE_URL", "mongodb://localhost:27017")}
+    return subprocess.run([sys.executable, *args], capture_output=True, text=True, env=env, check=True)
+
+
+def import_times() -> tuple[float, list]:
+    """Cumulative import time of main in ms and the self time of every imported module"""
+    result = python("-X", "importtime", "-c", "import main")
+    modules = []
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        modules.append((name.strip(), int(self_us) / 1000))
+        if name == "main":
+            total = int(cumulative_us) / 1000
+    return total, modules
+
+
+def first_response_time() -> float:
+    return float(python("-c", FIRST_RESPONSE).stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest modules to list")
+    parser.add_argument("--max-import-ms", type=float, help="fail when the median import time of main is higher")
+    parser.add_argument("--max-first-response-ms", type=float,
+                        help="fail when the median time to first response is higher")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    imports = []
+    slowest = {}
+    first_responses = []
+    for _ in range(args.runs):
+        total, modules = import_times()
+        imports.append(total)
+        for name, self_ms in modules:
+            slowest[name] = max(slowest.get(name, 0), self_ms)
+        first_responses.append(first_response_time())
+
+    results = {
+        "runs": args.runs,
+        "import_ms": round(statistics.median(imports), 2),
+        "first_response_ms": round(statistics.median(first_responses), 2),
+        "slowest_imports": [{"module": name, "self_ms": round(self_ms, 2)}
+                            for name, self_ms in sorted(slowest.items(), key=lambda item: -item[1])[:args.top]],
+    }
+    print(f"import main:            {results['import_ms']:>8.2f} ms (median of {args.runs})")
+    print(f"time to first response: {results['first_response_ms']:>6.2f} ms (median of {args.runs})")
+    print("slowest imports (self time):")
+    for module in results['slowest_imports']:
+        print(f"  {module['self_ms']:>8.2f} ms  {module['module']}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    failures = []
+    if args.max_import_ms is not None and results['import_ms'] > args.max_import_ms:
+        failures.append(f"import time {results['import_ms']} ms is above {args.max_import_ms} ms")
+    if args.max_first_response_ms is not None and results['first_response_ms'] > args.max_first_response_ms:
+        failures.append(f"time to first response {results['first_response_ms']} ms is above "
+                        f"{args.max_first_response_ms} ms")
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pydantic_settings import BaseSettings
 
 
@@ -5,8 +6,59 @@ class Settings(BaseSettings):
     APP_NAME: str = "Transportation Management System"
     DATABASE_URL: str
     DATABASE_NAME: str = "transport_management"
+    # "mongo" or "memory". The memory storage keeps everything in the worker process and needs no MongoDB, the
+    # endpoints which depend on MongoDB features (paging, import/export, queue, admin) then answer 503
+    STORAGE_BACKEND: str = "mongo"
+    # password hashing runs outside the event loop, in a "thread" or "process" pool
+    PASSWORD_HASH_EXECUTOR: str = "thread"
+    PASSWORD_HASH_WORKERS: int = 4
+    # signups waiting for a hash beyond this number are rejected instead of queued
+    PASSWORD_HASH_MAX_PENDING: int = 64
+    # read-through cache of vehicles, drivers and users
+    CACHE_TTL_SECONDS: float = 60
+    CACHE_MAX_SIZE: int = 10000
+    # publish cache invalidations to the other workers through MongoDB
+    CACHE_INVALIDATION_CHANNEL: bool = False
+    LOG_LEVEL: str = "INFO"
+    # MongoDB commands slower than this are logged and kept as samples
+    SLOW_QUERY_MS: float = 100
+    SLOW_QUERY_SAMPLES: int = 50
+    # MongoDB connection pool of each worker, MONGO_MIN_POOL_SIZE connections are opened at startup
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 10
+    MONGO_MAX_IDLE_TIME_MS: int | None = None
+    MONGO_CONNECT_TIMEOUT_MS: int = 10000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 10000
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: int | None = None
+    # comma separated wire compressors, e.g. "zstd,zlib"
+    MONGO_COMPRESSORS: str | None = None
+    MONGO_READ_PREFERENCE: str = "primary"
+    # background processing of queued allocation requests, when disabled they are allocated right away
+    ALLOCATION_QUEUE_ENABLED: bool = True
+    ALLOCATION_QUEUE_BATCH_SIZE: int = 500
+    ALLOCATION_QUEUE_POLL_INTERVAL: float = 0.5
+    ALLOCATION_QUEUE_CLAIM_TIMEOUT: int = 60
+    # live availability updates, changes are coalesced and pushed at most every AVAILABILITY_PUSH_INTERVAL seconds
+    AVAILABILITY_PUSH_INTERVAL: float = 0.2
+    AVAILABILITY_MAX_COALESCED: int = 100
+    AVAILABILITY_MAX_DATES: int = 90
+    # share changes between workers through a change stream on the rollups, needs a replica set
+    AVAILABILITY_CHANGE_STREAM: bool = False
+    # serialize list endpoints straight from raw BSON with orjson, skipping pydantic validation
+    FAST_JSON_RESPONSES: bool = False
+    # allocations older than ARCHIVE_HORIZON_DAYS are moved to monthly files in ARCHIVE_DIR, every
+    # ARCHIVE_INTERVAL_HOURS hours if set
+    ARCHIVE_HORIZON_DAYS: int = 365
+    ARCHIVE_DIR: str = "archive"
+    ARCHIVE_BATCH_SIZE: int = 5000
+    ARCHIVE_INTERVAL_HOURS: float | None = None
 
     class Config:
         env_file = ".env"
 
-settings = Settings()
\ No newline at end of file
+
+@lru_cache
+def get_settings() -> Settings:
+    """Settings are read from the environment on first use instead of on import, so importing the application does
+    not depend on the environment"""
+    return Settings()
@@ -0,0 +1,6 @@
+import logging
+
+
+def setup_logging(level: str):
+    """Configure the application loggers, messages below *level* are dropped before being formatted"""
+    logging.basicConfig(level=level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
@@ -0,0 +1,206 @@
+"""Index declarations for every collection and a query plan audit for the queries the routers issue.
+
+Indexes are created at startup by ensure_indexes, creating an existing index again is a no-op so it is safe to run on
+every start. Run `python -m db.indexes` to create them by hand, add `--audit` to also print the query plan audit.
+
+A unique index can't be created while the collection holds duplicates, e.g. allocations which booked a vehicle twice on
+a day before the date_vehicle index existed. The other indexes are still created, the missing unique index is logged
+and reported by /health/ready and /api/admin/query-plans. `python -m db.indexes --dedupe` moves such duplicate
+allocations (all but the first of a vehicle and day) to the allocation_duplicates collection, creates the indexes and
+rebuilds the allocation rollups.
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    "vehicles": [
+        IndexModel([("registration_number", ASCENDING)], name="registration_number_unique", unique=True),
+        IndexModel([("driver", ASCENDING)], name="driver"),
+    ],
+    "drivers": [
+        IndexModel([("license_number", ASCENDING)], name="license_number_unique", unique=True),
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "allocation": [
+        # availability of a day, unique so that a vehicle can't be allocated twice on the same day
+        IndexModel([("date", ASCENDING), ("vehicle", ASCENDING)], name="date_vehicle", unique=True),
+        IndexModel([("vehicle", ASCENDING), ("date", ASCENDING)], name="vehicle_date"),
+        IndexModel([("user", ASCENDING), ("date", ASCENDING)], name="user_date"),
+        # allocation of a queued request, unique so that a request claimed again after a timeout is not allocated twice
+        IndexModel([("request", ASCENDING)], name="request_unique", unique=True, sparse=True),
+        # allocations a rollup rebuild has not counted yet
+        IndexModel([("rollup_generation", ASCENDING)], name="rollup_generation"),
+    ],
+    "allocation_requests": [
+        IndexModel([("status", ASCENDING), ("date", ASCENDING), ("created_at", ASCENDING)], name="status_date"),
+        IndexModel([("claim", ASCENDING)], name="claim", sparse=True),
+    ],
+    "allocation_rollup": [
+        IndexModel([("generation", ASCENDING), ("kind", ASCENDING), ("key", ASCENDING), ("date", ASCENDING)],
+                   name="generation_kind_key_date", unique=True),
+        IndexModel([("generation", ASCENDING), ("kind", ASCENDING), ("date", ASCENDING)], name="generation_kind_date"),
+    ],
+}
+
+# indexes replaced by a declaration above with other options, dropped before the indexes are created
+OBSOLETE_INDEXES = {
+    "allocation": ["request"],
+    "allocation_rollup": ["kind_key_date", "kind_date"],
+}
+
+# queries issued by the routers, as explainable commands. Values in filters are placeholders, only the shape matters
+HOT_QUERIES = [
+    ("vehicle by registration number", {"find": "vehicles", "filter": {"registration_number": ""}, "limit": 1}),
+    ("vehicles assigned to a driver", {"count": "vehicles", "query": {"driver": ObjectId()}}),
+    ("free vehicles", {"find": "vehicles", "filter": {"_id": {"$nin": [ObjectId()]}}, "sort": {"_id": 1}, "limit": 1}),
+    ("driver by license number", {"find": "drivers", "filter": {"license_number": ""}, "limit": 1}),
+    ("user by email", {"find": "users", "filter": {"email": ""}, "limit": 1}),
+    ("allocated vehicles on a day", {"distinct": "allocation", "key": "vehicle", "query": {"date": ""}}),
+    ("allocations of a date range", {"find": "allocation", "filter": {"date": {"$gte": "", "$lte": ""}},
+                                     "projection": {"_id": 0, "date": 1, "vehicle": 1}}),
+    ("vehicle allocation report", {"count": "allocation", "query": {"vehicle": ObjectId(), "date": {"$gte": "", "$lte": ""}}}),
+    ("user allocation report", {"count": "allocation", "query": {"user": ObjectId(), "date": {"$gte": "", "$lte": ""}}}),
+    ("allocation rollup of a vehicle/user", {"find": "allocation_rollup", "filter": {"generation": 0, "kind": "", "key": ObjectId(),
+                                             "date": {"$gte": "", "$lte": ""}}}),
+    ("allocation rollups of a period", {"find": "allocation_rollup", "filter": {"generation": 0, "kind": "",
+                                        "date": {"$gte": "", "$lte": ""}}}),
+]
+
+
+DUPLICATES_COLLECTION = "allocation_duplicates"
+
+
+async def ensure_indexes(db, collections: list = None) -> list:
+    """
+    Create the declared indexes one by one, so an index which can't be created (e.g. existing duplicates for a unique
+    index) does not keep the others from being created.
+    :param db: database instance
+    :param collections: only create the indexes of these collections, default all
+    :return: "collection.index" of every index which could not be created
+    """
+    failed = []
+    for collection, indexes in INDEXES.items():
+        if collections is not None and collection not in collections:
+            continue
+        obsolete = set(OBSOLETE_INDEXES.get(collection, ())) & set(await db[collection].index_information())
+        for name in obsolete:
+            await db[collection].drop_index(name)
+            logger.info("Dropped obsolete index %s on %s", name, collection)
+        for index in indexes:
+            try:
+                await db[collection].create_indexes([index])
+            except OperationFailure as error:
+                failed.append(f"{collection}.{index.document['name']}")
+                logger.error("Could not create index %s on %s: %s", index.document['name'], collection, error)
+    if failed:
+        logger.error("Indexes missing: %s. Duplicate allocations can be removed with `python -m db.indexes --dedupe`",
+                     ", ".join(failed))
+    return failed
+
+
+async def get_missing_unique_indexes(db) -> list:
+    """"collection.index" of every declared unique index which does not exist in the database"""
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = await db[collection].index_information()
+        missing.extend(f"{collection}.{index.document['name']}" for index in indexes
+                       if index.document.get('unique') and index.document['name'] not in existing)
+    return missing
+
+
+async def dedupe_allocations(db) -> int:
+    """
+    Keep the first allocation (lowest _id) of every vehicle and day and move the others to allocation_duplicates, so
+    the unique date_vehicle index can be created. Rollups have to be rebuilt afterwards.
+    :param db: database instance
+    :return: number of moved allocations
+    """
+    moved = 0
+    duplicates = db['allocation'].aggregate([
+        {"$group": {"_id": {"date": "$date", "vehicle": "$vehicle"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    async for duplicate in duplicates:
+        ids = sorted(duplicate['ids'])[1:]
+        allocations = await db['allocation'].find({"_id": {"$in": ids}}).to_list(None)
+        if not allocations:
+            continue
+        await db[DUPLICATES_COLLECTION].insert_many(
+            [{**allocation, "moved_at": datetime.now()} for allocation in allocations], ordered=False
+        )
+        result = await db['allocation'].delete_many({"_id": {"$in": [allocation['_id'] for allocation in allocations]}})
+        moved += result.deleted_count
+    logger.info("Moved %s duplicate allocations to %s", moved, DUPLICATES_COLLECTION)
+    return moved
+
+
+def _plan_stages(plan: dict) -> list:
+    """Return the names of all stages of a (winning) query plan"""
+    stages = [plan['stage']] if 'stage' in plan else []
+    for child in [plan.get('inputStage'), plan.get('queryPlan'), *plan.get('inputStages', [])]:
+        if child:
+            stages.extend(_plan_stages(child))
+    return stages
+
+
+async def audit_query_plans(db) -> list:
+    """
+    Run explain on every hot query and report the winning plan stages, a query whose plan contains a COLLSCAN is flagged.
+    :param db: database instance
+    :return: list of dict with name, collection, stages and collection_scan for every query
+    """
+    report = []
+    for name, command in HOT_QUERIES:
+        collection = next(iter(command.values()))
+        explain = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        stages = _plan_stages(explain['queryPlanner']['winningPlan'])
+        report.append({
+            "name": name,
+            "collection": collection,
+            "stages": stages,
+            "collection_scan": "COLLSCAN" in stages,
+        })
+    return report
+
+
+async def main():
+    from db.mongodb import MongoDB
+
+    parser = argparse.ArgumentParser(description="Create the indexes and optionally audit the query plans")
+    parser.add_argument("--audit", action="store_true", help="print the query plan of every hot query")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="move duplicate allocations of a vehicle and day aside first, then rebuild the rollups")
+    args = parser.parse_args()
+
+    database = MongoDB()
+    await database.connect()
+    db = database.get_database()
+    if args.dedupe:
+        from services.rollup import rebuild_rollups
+
+        print(f"moved {await dedupe_allocations(db)} duplicate allocations to {DUPLICATES_COLLECTION}")
+    failed = await ensure_indexes(db)
+    if args.dedupe:
+        rollups = await rebuild_rollups(db)
+        print("allocation rollups are being rebuilt by another process" if rollups is None
+              else f"rebuilt {rollups} allocation rollups")
+    if failed:
+        print(f"could not create: {', '.join(failed)}")
+    if args.audit:
+        for query in await audit_query_plans(db):
+            flag = "COLLSCAN" if query['collection_scan'] else "ok"
+            print(f"{flag:<8} {query['collection']:<12} {query['name']:<32} {' <- '.join(query['stages'])}")
+    await database.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+"""Leases stored in MongoDB, so that a job runs in one process at a time across all uvicorn workers and hosts.
+
+A lease is a document {_id: name, holder, expires_at}. It is taken when it does not exist or has expired and renewed by
+its holder while the job runs, a holder which dies loses it after LEASE_SECONDS.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+LEASE_COLLECTION = "leases"
+LEASE_SECONDS = 120
+HOLDER = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+async def acquire_lease(db, name: str, seconds: float = LEASE_SECONDS, holder: str = HOLDER) -> bool:
+    """Take or renew the lease *name* for *seconds* seconds, return False if another holder has it"""
+    now = datetime.now()
+    try:
+        lease = await db[LEASE_COLLECTION].find_one_and_update(
+            {"_id": name, "$or": [{"holder": holder}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": holder, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # the lease exists and is held by somebody else, the upsert tried to insert it a second time
+        return False
+    return lease is not None
+
+
+async def release_lease(db, name: str, holder: str = HOLDER):
+    await db[LEASE_COLLECTION].delete_one({"_id": name, "holder": holder})
+
+
+@asynccontextmanager
+async def hold_lease(db, name: str, seconds: float = LEASE_SECONDS, holder: str = HOLDER):
+    """Take the lease *name* and keep renewing it until the block is left. Yields whether the lease was taken, the
+    block should do nothing if not. A job which must also keep out jobs of its own process passes a *holder* of its own."""
+    if not await acquire_lease(db, name, seconds, holder):
+        yield False
+        return
+
+    async def renew():
+        while True:
+            await asyncio.sleep(seconds / 3)
+            try:
+                if not await acquire_lease(db, name, seconds, holder):
+                    logger.warning("Lost the %s lease", name)
+            except PyMongoError as error:
+                logger.warning("Could not renew the %s lease: %s", name, error)
+
+    renewal = asyncio.create_task(renew())
+    try:
+        yield True
+    finally:
+        renewal.cancel()
+        await release_lease(db, name, holder)
@@ -1,33 +1,81 @@
+import asyncio
+import logging
+import time
+from fastapi import HTTPException
 from motor.motor_asyncio import AsyncIOMotorClient
-from core.config import settings
+from starlette.requests import HTTPConnection
+from core.config import get_settings
+from db.monitoring import command_listener, pool_listener
+
+logger = logging.getLogger(__name__)
 
 
 class MongoDB:
-    """This class is responsible for handling MongoDB connection and database operations. It is a singleton class,
-    so only one instance of this class will be created and shared across the application."""
-    _instance = None
-
-    def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super(MongoDB, cls).__new__(cls, *args, **kwargs)
-        return cls._instance
-
-    def __init__(self, uri: str = settings.DATABASE_URL, db_name: str = settings.DATABASE_NAME):
-        if not hasattr(self, 'initialized'):
-            print("Initializing MongoDB")
-            self.client = None
-            self.db_name = db_name
-            self.uri = uri
+    """This class is responsible for handling MongoDB connection and database operations. The application creates one
+    instance in create_app, keeps it in app.state and hands its database to the routes through the get_database
+    dependency."""
+
+    def __init__(self, uri: str = None, db_name: str = None):
+        settings = get_settings()
+        self.client = None
+        self.db_name = db_name or settings.DATABASE_NAME
+        self.uri = uri or settings.DATABASE_URL
+
+    @staticmethod
+    def get_client_options() -> dict:
+        """Connection pool and client options from the settings, unset options are left to the driver defaults"""
+        settings = get_settings()
+        options = {
+            "maxPoolSize": settings.MONGO_MAX_POOL_SIZE,
+            "minPoolSize": settings.MONGO_MIN_POOL_SIZE,
+            "maxIdleTimeMS": settings.MONGO_MAX_IDLE_TIME_MS,
+            "connectTimeoutMS": settings.MONGO_CONNECT_TIMEOUT_MS,
+            "serverSelectionTimeoutMS": settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            "waitQueueTimeoutMS": settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            "compressors": settings.MONGO_COMPRESSORS,
+            "readPreference": settings.MONGO_READ_PREFERENCE,
+        }
+        return {option: value for option, value in options.items() if value is not None}
 
     async def connect(self):
-        self.client = AsyncIOMotorClient(self.uri)
-        print("Connected to MongoDB")
+        command_listener.configure(get_settings().SLOW_QUERY_MS, get_settings().SLOW_QUERY_SAMPLES)
+        self.client = AsyncIOMotorClient(
+            self.uri, event_listeners=[command_listener, pool_listener], **self.get_client_options()
+        )
+        logger.info("Connected to MongoDB")
+
+    async def ping(self) -> float:
+        """Round trip to the server, return its duration in ms"""
+        started = time.perf_counter()
+        await self.client.admin.command("ping")
+        return (time.perf_counter() - started) * 1000
+
+    async def warmup(self, connections: int):
+        """Open *connections* connections up front by running that many pings at once, so the first requests after a
+        start don't pay for connection setup"""
+        await self.ping()
+        if connections > 1:
+            await asyncio.gather(*[self.ping() for _ in range(connections)])
+        logger.info("MongoDB connection pool warmed up with %s connections", connections)
 
     async def close(self):
         if self.client:
             self.client.close()
-            self._instance = None
-            print("Disconnected from MongoDB")
+            self.client = None
+            logger.info("Disconnected from MongoDB")
 
     def get_database(self):
-        return self.client.get_database('transport_management')
+        return self.client.get_database(self.db_name)
+
+
+def get_mongodb(connection: HTTPConnection) -> MongoDB:
+    """Dependency returning the MongoDB instance of the application"""
+    return connection.app.state.mongodb
+
+
+def get_database(connection: HTTPConnection):
+    """Dependency returning the database of the application, 503 while it is not connected"""
+    mongodb = get_mongodb(connection)
+    if not mongodb.client:
+        raise HTTPException(status_code=503, detail="Database not connected")
+    return mongodb.get_database()
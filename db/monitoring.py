@@ -0,0 +1,172 @@
+"""pymongo event listeners attached to the motor client.
+
+CommandTimingListener records the duration of every command per collection and operation and keeps a sample of the
+slowest recent commands. Only the shape of a slow command (filter/sort fields) is kept, never its values.
+PoolStatsListener keeps live connection pool statistics per server.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from pymongo import monitoring
+from services.metrics import mongodb_command_duration, mongodb_command_failures
+
+logger = logging.getLogger(__name__)
+
+
+def _command_shape(command_name: str, command: dict) -> dict:
+    shape = {}
+    for field in ("filter", "query", "sort", "key"):
+        value = command.get(field)
+        if isinstance(value, dict):
+            shape[field] = list(value)
+        elif isinstance(value, str):
+            shape[field] = value
+    if command_name == "aggregate":
+        shape['pipeline'] = [next(iter(stage), None) for stage in command.get("pipeline", []) if isinstance(stage, dict)]
+    return shape
+
+
+class CommandTimingListener(monitoring.CommandListener):
+    def __init__(self, slow_query_ms: float = 100, samples: int = 50):
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries = deque(maxlen=samples)
+        # commands in flight: (connection, request id) -> (collection, shape)
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def configure(self, slow_query_ms: float, samples: int):
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries = deque(self.slow_queries, maxlen=samples)
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = ""
+        with self._lock:
+            self._started[(event.connection_id, event.request_id)] = (
+                collection, _command_shape(event.command_name, event.command)
+            )
+
+    def _finished(self, event) -> str:
+        with self._lock:
+            collection, shape = self._started.pop((event.connection_id, event.request_id), ("", {}))
+        duration_ms = event.duration_micros / 1000
+        mongodb_command_duration.observe(duration_ms / 1000, collection, event.command_name)
+        if duration_ms >= self.slow_query_ms:
+            self.slow_queries.append({
+                "time": time.time(),
+                "database": event.database_name,
+                "collection": collection,
+                "command": event.command_name,
+                "duration_ms": duration_ms,
+                "shape": shape,
+            })
+            logger.warning("Slow MongoDB %s on %s took %.1f ms", event.command_name, collection, duration_ms)
+        return collection
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        collection = self._finished(event)
+        mongodb_command_failures.inc(collection, event.command_name)
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Counts connections created/closed and checked out per server and how long check outs waited for a connection"""
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+        # motor runs pymongo in worker threads, a check out starts and ends on the same thread
+        self._local = threading.local()
+
+    def _pool(self, address) -> dict:
+        return self._pools.setdefault(f"{address[0]}:{address[1]}", {
+            "created": 0, "closed": 0, "open": 0, "checked_out": 0, "check_outs": 0, "check_out_failures": 0,
+            "wait_time_ms": 0.0, "max_wait_time_ms": 0.0, "cleared": 0,
+        })
+
+    def _wait_time(self, event) -> float:
+        duration = getattr(event, "duration", None)
+        if duration is None:
+            duration = time.perf_counter() - getattr(self._local, "started", time.perf_counter())
+        return duration * 1000
+
+    def pool_created(self, event):
+        with self._lock:
+            self._pool(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._pool(event.address)['cleared'] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['created'] += 1
+            pool['open'] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['closed'] += 1
+            pool['open'] -= 1
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        wait_time = self._wait_time(event)
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['check_out_failures'] += 1
+            pool['wait_time_ms'] += wait_time
+
+    def connection_checked_out(self, event):
+        wait_time = self._wait_time(event)
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['checked_out'] += 1
+            pool['check_outs'] += 1
+            pool['wait_time_ms'] += wait_time
+            pool['max_wait_time_ms'] = max(pool['max_wait_time_ms'], wait_time)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._pool(event.address)['checked_out'] -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            pools = {}
+            for address, pool in self._pools.items():
+                pools[address] = dict(pool)
+                pools[address]['avg_wait_time_ms'] = (
+                    round(pool['wait_time_ms'] / pool['check_outs'], 3) if pool['check_outs'] else 0
+                )
+            return pools
+
+
+# configured from the settings when the client connects
+command_listener = CommandTimingListener()
+pool_listener = PoolStatsListener()
+
+
+def get_slow_queries() -> list:
+    return sorted(command_listener.slow_queries, key=lambda query: query['time'], reverse=True)
+
+
+def get_pool_stats() -> dict:
+    return pool_listener.stats()
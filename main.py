@@ -1,30 +1,108 @@
+import asyncio
+import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from fastapi.exceptions import RequestValidationError
-from core.config import settings
-from db.mongodb import MongoDB
-from api.vehicle import router as vehicle_router
-from api.users import router as user_router
-from api.drivers import router as driver_router
-from api.report import router as report_router
-from services.custom_response import validation_exception_handler
+from core.config import get_settings
+from core.logging import setup_logging
+
+logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def on_startup(app: FastAPI):
-    print("Connecting to Database")
-    db_instance = MongoDB()
-    client = await db_instance.connect()
+    from db.indexes import ensure_indexes
+    from services.cache import listen_for_invalidations
+    from services.allocation_queue import run_allocation_worker
+    from services.availability_hub import watch_allocation_changes
+    from services.archive import run_archiver
+    from services.rollup import ensure_rollups
+    from storage.mongo import MongoStorage
+
+    settings = get_settings()
+    if settings.STORAGE_BACKEND == "memory":
+        logger.info("Using the in-memory storage, nothing is persisted")
+        yield
+        app.state.hasher.shutdown()
+        return
+
+    db_instance = app.state.mongodb
+    logger.info("Connecting to Database")
+    await db_instance.connect()
+    await db_instance.warmup(settings.MONGO_MIN_POOL_SIZE)
+    await ensure_indexes(db_instance.get_database())
+    app.state.storage = MongoStorage(db_instance.get_database())
+    # in the background, reports read the previous counters until a rebuild switches over
+    background_tasks = [asyncio.create_task(ensure_rollups(db_instance.get_database()))]
+    if settings.CACHE_INVALIDATION_CHANNEL:
+        background_tasks.append(asyncio.create_task(listen_for_invalidations(db_instance.get_database())))
+    if settings.ALLOCATION_QUEUE_ENABLED:
+        background_tasks.append(asyncio.create_task(run_allocation_worker(db_instance.get_database())))
+    if settings.AVAILABILITY_CHANGE_STREAM:
+        background_tasks.append(asyncio.create_task(watch_allocation_changes(db_instance.get_database())))
+    if settings.ARCHIVE_INTERVAL_HOURS:
+        background_tasks.append(asyncio.create_task(run_archiver(db_instance.get_database())))
     yield
+    for task in background_tasks:
+        task.cancel()
+    app.state.hasher.shutdown()
+    app.state.storage = None
     await db_instance.close()
 
 
-app = FastAPI(title=settings.APP_NAME, lifespan=on_startup)
-app.add_exception_handler(RequestValidationError, validation_exception_handler)
-app.include_router(vehicle_router, prefix="/api/vehicles", tags=["vehicles"])
-app.include_router(user_router, prefix="/api/user", tags=["user"])
-app.include_router(driver_router, prefix="/api/drivers", tags=["driver"])
-app.include_router(report_router, prefix="/api/report", tags=["report"])
+def create_app() -> FastAPI:
+    """Build the application. Settings, routers and the database client are only set up here, so importing this module
+    stays cheap and does not need the environment. Run it with `uvicorn main:create_app --factory`."""
+    from fastapi.exceptions import RequestValidationError
+    from fastapi.responses import PlainTextResponse
+    from db.mongodb import MongoDB
+    from api.vehicle import router as vehicle_router
+    from api.users import router as user_router
+    from api.drivers import router as driver_router
+    from api.report import router as report_router
+    from api.admin import router as admin_router
+    from api.health import router as health_router
+    from services.custom_response import validation_exception_handler
+    from services.metrics import MetricsMiddleware, render_metrics
+    from services.service import PasswordHasher
+    from storage.memory import MemoryStorage
+
+    settings = get_settings()
+    setup_logging(settings.LOG_LEVEL)
+
+    app = FastAPI(title=settings.APP_NAME, lifespan=on_startup)
+    # the client itself is only created when the application starts, the mongo storage along with it
+    app.state.mongodb = MongoDB(settings.DATABASE_URL, settings.DATABASE_NAME)
+    app.state.storage = MemoryStorage() if settings.STORAGE_BACKEND == "memory" else None
+    app.state.hasher = PasswordHasher(settings.PASSWORD_HASH_EXECUTOR, settings.PASSWORD_HASH_WORKERS,
+                                      settings.PASSWORD_HASH_MAX_PENDING)
+    app.add_exception_handler(RequestValidationError, validation_exception_handler)
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(vehicle_router, prefix="/api/vehicles", tags=["vehicles"])
+    app.include_router(user_router, prefix="/api/user", tags=["user"])
+    app.include_router(driver_router, prefix="/api/drivers", tags=["driver"])
+    app.include_router(report_router, prefix="/api/report", tags=["report"])
+    app.include_router(admin_router, prefix="/api/admin", tags=["admin"])
+    app.include_router(health_router, prefix="/health", tags=["health"])
+
+    @app.get("/")
+    async def read_root():
+        return {"Hello": "World"}
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        """Request and MongoDB command metrics in the Prometheus text format"""
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+    return app
+
+
+_app = None
+
 
-@app.get("/")
-async def read_root():
-    return {"Hello": "World"}
\ No newline at end of file
+def __getattr__(name):
+    # `main:app` keeps working, the application is created on first access
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,132 @@
+"""Queue of allocation requests processed in the background, batched per date.
+
+Requests are stored in the allocation_requests collection so they survive a restart. A worker claims up to
+ALLOCATION_QUEUE_BATCH_SIZE pending requests of one date at a time and allocates them with allocate_vehicles, which
+computes the availability of that date once for the whole batch. Claims are atomic per request, so several workers (in
+one or many processes) can drain the same queue. A claim which is not finished within ALLOCATION_QUEUE_CLAIM_TIMEOUT
+seconds (e.g. the worker died) is handed out again. Allocations carry the id of their request, unique by an index, so
+a request which was already allocated by a worker which died or is still running is not allocated twice.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from core.config import get_settings
+from services.service import ALLOCATION_DATE_FORMAT, allocate_vehicles
+from storage.mongo import MongoStorage
+
+logger = logging.getLogger(__name__)
+
+QUEUE_COLLECTION = "allocation_requests"
+PENDING = "pending"
+PROCESSING = "processing"
+ALLOCATED = "allocated"
+FAILED = "failed"
+
+
+async def enqueue_allocation(db, user_id, date) -> dict:
+    """Store a validated allocation request as pending and return it"""
+    now = datetime.now()
+    request = {"user": user_id, "date": date.strftime(ALLOCATION_DATE_FORMAT), "status": PENDING,
+               "created_at": now, "updated_at": now}
+    await db[QUEUE_COLLECTION].insert_one(request)
+    return request
+
+
+async def release_stale_claims(db) -> int:
+    """Put requests claimed by a worker which did not finish them in time back to pending"""
+    expired = datetime.now() - timedelta(seconds=get_settings().ALLOCATION_QUEUE_CLAIM_TIMEOUT)
+    result = await db[QUEUE_COLLECTION].update_many(
+        {"status": PROCESSING, "claimed_at": {"$lt": expired}},
+        {"$set": {"status": PENDING, "updated_at": datetime.now()}, "$unset": {"worker": "", "claimed_at": ""}}
+    )
+    return result.modified_count
+
+
+async def claim_batch(db, date: str, worker: str) -> list:
+    """Claim up to ALLOCATION_QUEUE_BATCH_SIZE pending requests of a date, oldest first"""
+    pending = await db[QUEUE_COLLECTION].find(
+        {"status": PENDING, "date": date}, {"_id": 1}
+    ).sort("created_at", 1).limit(get_settings().ALLOCATION_QUEUE_BATCH_SIZE).to_list(None)
+    if not pending:
+        return []
+
+    # the status condition makes sure a request is only claimed by one worker
+    claim = uuid.uuid4().hex
+    await db[QUEUE_COLLECTION].update_many(
+        {"_id": {"$in": [request['_id'] for request in pending]}, "status": PENDING},
+        {"$set": {"status": PROCESSING, "worker": worker, "claim": claim, "claimed_at": datetime.now()}}
+    )
+    return await db[QUEUE_COLLECTION].find({"claim": claim, "status": PROCESSING}).to_list(None)
+
+
+async def process_batch(db, requests: list):
+    """Allocate a batch of claimed requests of one date and store the outcome of every request. Requests whose date is
+    no longer in the future by now fail"""
+    # requests which got their allocation before a previous worker died are finished, not allocated again
+    done = await db['allocation'].find(
+        {"request": {"$in": [request['_id'] for request in requests]}}
+    ).to_list(None)
+    done = {allocation['request']: allocation for allocation in done}
+
+    # a request queued for tomorrow which is only processed tomorrow is too late, like it is on /allocate/user
+    too_late = requests[0]['date'] <= datetime.now().strftime(ALLOCATION_DATE_FORMAT)
+    todo = [] if too_late else [request for request in requests if request['_id'] not in done]
+    allocations = await allocate_vehicles(
+        [(request['user'], datetime.strptime(request['date'], ALLOCATION_DATE_FORMAT).date()) for request in todo],
+        MongoStorage(db),
+        extra=[{"request": request['_id']} for request in todo]
+    )
+    done.update({request['_id']: allocation for request, allocation in zip(todo, allocations) if allocation})
+    # a request claimed again after a timeout may have been allocated by its first worker meanwhile, the unique request
+    # index made the write of this worker fail
+    missing = [request['_id'] for request in todo if request['_id'] not in done]
+    if missing:
+        async for allocation in db['allocation'].find({"request": {"$in": missing}}):
+            done[allocation['request']] = allocation
+
+    now = datetime.now()
+    operations = []
+    for request in requests:
+        allocation = done.get(request['_id'])
+        if allocation:
+            update = {"status": ALLOCATED, "allocation": allocation['_id'], "vehicle": allocation['vehicle'],
+                      "message": "User assigned to vehicle successfully"}
+        elif too_late:
+            update = {"status": FAILED, "message": "Allocation date should be tomorrow or later"}
+        else:
+            update = {"status": FAILED, "message": "No vehicle available for allocation"}
+        operations.append(UpdateOne({"_id": request['_id'], "claim": request['claim']},
+                                    {"$set": {**update, "updated_at": now}, "$unset": {"claimed_at": ""}}))
+    await db[QUEUE_COLLECTION].bulk_write(operations, ordered=False)
+
+
+async def drain_queue(db, worker: str) -> int:
+    """Process all pending requests, one batch per date at a time, return the number of processed requests"""
+    processed = 0
+    await release_stale_claims(db)
+    for date in sorted(await db[QUEUE_COLLECTION].distinct("date", {"status": PENDING})):
+        while True:
+            requests = await claim_batch(db, date, worker)
+            if not requests:
+                break
+            await process_batch(db, requests)
+            processed += len(requests)
+    return processed
+
+
+async def run_allocation_worker(db):
+    """Drain the queue until cancelled, polling every ALLOCATION_QUEUE_POLL_INTERVAL seconds when it is empty"""
+    worker = uuid.uuid4().hex
+    logger.info("Allocation queue worker %s started", worker)
+    while True:
+        try:
+            processed = await drain_queue(db, worker)
+            if processed:
+                logger.debug("Allocation queue worker %s processed %s requests", worker, processed)
+                continue
+        except PyMongoError as error:
+            logger.warning("Allocation queue worker %s failed: %s", worker, error)
+        await asyncio.sleep(get_settings().ALLOCATION_QUEUE_POLL_INTERVAL)
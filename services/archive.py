@@ -0,0 +1,126 @@
+"""Archival of past allocations to monthly compressed files.
+
+Allocations older than ARCHIVE_HORIZON_DAYS are only read by reports, which are served from the allocation rollups, so
+they are moved out of the allocation collection into ARCHIVE_DIR/allocation-YYYY-MM.jsonl.gz (MongoDB extended json,
+one allocation per line). A batch is deleted from the collection only after its file has been written and synced, a
+batch interrupted in between is archived again and duplicates are dropped when the files are read. The
+allocation_archive collection lists the archived months. Only one process archives at a time, the others skip their
+run while the archiver lease is held, so the files are never appended to concurrently and every month is counted once.
+
+Run `python -m services.archive` to archive by hand.
+"""
+import asyncio
+import gzip
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from bson import json_util
+from core.config import get_settings
+from db.lease import hold_lease
+from services.service import ALLOCATION_DATE_FORMAT
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLLECTION = "allocation_archive"
+ARCHIVE_LEASE = "archiver"
+
+
+def get_archive_path(month: str) -> str:
+    return os.path.join(get_settings().ARCHIVE_DIR, f"allocation-{month}.jsonl.gz")
+
+
+def _append_to_archive(month: str, allocations: list):
+    os.makedirs(get_settings().ARCHIVE_DIR, exist_ok=True)
+    # every append adds a gzip member, gzip reads multi member files as one stream
+    with open(get_archive_path(month), "ab") as file:
+        with gzip.GzipFile(fileobj=file, mode="wb") as archive:
+            for allocation in allocations:
+                archive.write(json_util.dumps(allocation).encode() + b"\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def read_archive(month: str) -> list:
+    """Allocations archived for a month (YYYY-MM). Raises FileNotFoundError when the file of the month is missing, e.g.
+    when ARCHIVE_DIR is not the same on every host, its allocations are gone from the collection so they must not be
+    taken as none"""
+    path = get_archive_path(month)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Archive file {path} of {month} is missing")
+    allocations = {}
+    with gzip.open(path, "rt") as archive:
+        for line in archive:
+            allocation = json_util.loads(line)
+            allocations[allocation['_id']] = allocation
+    return list(allocations.values())
+
+
+async def get_archived_months(db) -> list:
+    return [month['_id'] async for month in db[ARCHIVE_COLLECTION].find({}, {"_id": 1}).sort("_id", 1)]
+
+
+async def archive_allocations(db, horizon_days: int = None) -> int|None:
+    """
+    Move allocations older than *horizon_days* days (default ARCHIVE_HORIZON_DAYS) to the monthly archive files.
+    :param db: database instance
+    :return: number of archived allocations, None if another process is archiving
+    """
+    async with hold_lease(db, ARCHIVE_LEASE) as acquired:
+        if not acquired:
+            logger.info("Allocations are being archived by another process, skipped")
+            return None
+        return await _archive_allocations(db, horizon_days)
+
+
+async def _archive_allocations(db, horizon_days: int = None) -> int:
+    horizon_days = get_settings().ARCHIVE_HORIZON_DAYS if horizon_days is None else horizon_days
+    cutoff = (datetime.now().date() - timedelta(days=horizon_days)).strftime(ALLOCATION_DATE_FORMAT)
+    archived = 0
+    while True:
+        batch = await db['allocation'].find({"date": {"$lt": cutoff}}).sort("date", 1).limit(
+            get_settings().ARCHIVE_BATCH_SIZE).to_list(None)
+        if not batch:
+            break
+
+        months = defaultdict(list)
+        for allocation in batch:
+            months[allocation['date'][:7]].append(allocation)
+        for month, allocations in months.items():
+            await asyncio.to_thread(_append_to_archive, month, allocations)
+            await db[ARCHIVE_COLLECTION].update_one(
+                {"_id": month},
+                {"$inc": {"count": len(allocations)}, "$set": {"file": get_archive_path(month),
+                                                               "updated_at": datetime.now()}},
+                upsert=True
+            )
+        await db['allocation'].delete_many({"_id": {"$in": [allocation['_id'] for allocation in batch]}})
+        archived += len(batch)
+
+    if archived:
+        logger.info("Archived %s allocations older than %s", archived, cutoff)
+    return archived
+
+
+async def run_archiver(db):
+    """Archive every ARCHIVE_INTERVAL_HOURS hours until cancelled"""
+    while True:
+        try:
+            await archive_allocations(db)
+        except Exception as error:
+            logger.exception("Archiving allocations failed: %s", error)
+        await asyncio.sleep(get_settings().ARCHIVE_INTERVAL_HOURS * 3600)
+
+
+async def main():
+    from db.mongodb import MongoDB
+
+    database = MongoDB()
+    await database.connect()
+    archived = await archive_allocations(database.get_database())
+    print("Another process is archiving" if archived is None else f"Archived {archived} allocations")
+    await database.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
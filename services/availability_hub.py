@@ -0,0 +1,128 @@
+"""In-process fan-out of availability changes to websocket subscribers.
+
+The allocate, update and cancel paths publish every change of the number of allocations of a date. Each subscription
+coalesces the changes of its dates into one net change per date, which its sender flushes at most every
+AVAILABILITY_PUSH_INTERVAL seconds, so a burst of bookings turns into a single message. A subscriber which falls behind
+by more than AVAILABILITY_MAX_COALESCED changes of a date gets a fresh snapshot of that date instead.
+
+With AVAILABILITY_CHANGE_STREAM enabled (needs a replica set) changes are not published locally, instead every worker
+watches the daily fleet counters of the allocation rollups and refreshes the dates whose counter changed, so the
+subscribers of every worker see the writes of all workers.
+"""
+import asyncio
+import logging
+from pymongo.errors import PyMongoError
+from core.config import get_settings
+from services.rollup import FLEET, ROLLUP_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, dates: set):
+        self.dates = dates
+        # date -> [net change of allocations, number of coalesced changes]
+        self.changes = {}
+        # dates which need a fresh snapshot
+        self.refresh = set()
+        self._event = asyncio.Event()
+
+    def push(self, date: str, amount: int):
+        if date in self.refresh:
+            return
+        change = self.changes.setdefault(date, [0, 0])
+        change[0] += amount
+        change[1] += 1
+        if change[1] > get_settings().AVAILABILITY_MAX_COALESCED:
+            # too far behind, a snapshot is cheaper than the accumulated changes
+            del self.changes[date]
+            self.refresh.add(date)
+        self._event.set()
+
+    def push_refresh(self, date: str):
+        self.changes.pop(date, None)
+        self.refresh.add(date)
+        self._event.set()
+
+    async def next_updates(self) -> tuple:
+        """Wait for updates, then return (net change per date, dates to refresh) accumulated during the push interval"""
+        await self._event.wait()
+        await asyncio.sleep(get_settings().AVAILABILITY_PUSH_INTERVAL)
+        self._event.clear()
+        changes = {date: change[0] for date, change in self.changes.items() if change[0]}
+        refresh = self.refresh
+        self.changes = {}
+        self.refresh = set()
+        return changes, refresh
+
+
+class AvailabilityHub:
+    def __init__(self):
+        # date -> subscriptions of that date
+        self._subscriptions = {}
+
+    def subscribe(self, dates: set) -> Subscription:
+        subscription = Subscription(dates)
+        for date in dates:
+            self._subscriptions.setdefault(date, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        for date in subscription.dates:
+            subscriptions = self._subscriptions.get(date)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[date]
+
+    def publish(self, date: str, amount: int):
+        for subscription in self._subscriptions.get(date, ()):
+            subscription.push(date, amount)
+
+    def refresh(self, date: str):
+        for subscription in self._subscriptions.get(date, ()):
+            subscription.push_refresh(date)
+
+    def subscribers(self) -> int:
+        return len({subscription for subscriptions in self._subscriptions.values() for subscription in subscriptions})
+
+
+hub = AvailabilityHub()
+
+
+def publish_allocation_changes(allocations: list, amount: int = 1):
+    """Publish allocations added (amount=1) or removed (amount=-1) to the subscribers of their dates"""
+    if get_settings().AVAILABILITY_CHANGE_STREAM:
+        return
+    for allocation in allocations:
+        hub.publish(allocation['date'], amount)
+
+
+def publish_allocation_change(old: dict, new: dict):
+    """Publish an allocation moved from one date to another"""
+    if old['date'] != new['date']:
+        publish_allocation_changes([old], -1)
+        publish_allocation_changes([new], 1)
+
+
+async def get_availability_snapshot(storage, date: str) -> dict:
+    """Number of vehicles and of allocations on a date (YYYY-MM-DD)"""
+    vehicles = await storage.vehicles.count()
+    allocated = len(await storage.allocations.vehicles_on(date))
+    return {"vehicles": vehicles, "allocated": allocated, "free": max(0, vehicles - allocated)}
+
+
+async def watch_allocation_changes(db):
+    """Refresh the subscribers of every date whose fleet allocation counter changes, in any worker. Runs until
+    cancelled."""
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+    while True:
+        try:
+            async with db[ROLLUP_COLLECTION].watch(pipeline, full_document="updateLookup") as stream:
+                async for change in stream:
+                    document = change.get('fullDocument')
+                    if document and document.get('kind') == FLEET:
+                        hub.refresh(document['date'])
+        except PyMongoError as error:
+            logger.warning("Availability change stream error: %s", error)
+        await asyncio.sleep(1)
@@ -0,0 +1,148 @@
+"""In-process read-through cache for vehicles, drivers and users looked up by id.
+
+Entries expire after CACHE_TTL_SECONDS and the least recently used entry is evicted once a cache holds CACHE_MAX_SIZE
+entries. Write paths invalidate the entries they change. With CACHE_INVALIDATION_CHANNEL enabled every invalidation is
+also published to a capped collection which all workers tail, so the caches of other uvicorn workers drop the entry too.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, PyMongoError
+from core.config import get_settings
+
+INVALIDATION_COLLECTION = "cache_invalidation"
+# size of the capped invalidation collection in bytes
+INVALIDATION_COLLECTION_SIZE = 1024 * 1024
+WORKER_ID = uuid.uuid4().hex
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """LRU cache whose entries also expire after *ttl* seconds"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # incremented on every invalidation, a lookup which started before an invalidation must not store its result
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, generation: int = None):
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+        }
+
+
+@lru_cache
+def get_caches() -> dict:
+    """Caches per collection, created on first use from the settings"""
+    settings = get_settings()
+    return {
+        collection: TTLCache(collection, settings.CACHE_MAX_SIZE, settings.CACHE_TTL_SECONDS)
+        for collection in ("vehicles", "drivers", "users")
+    }
+
+
+async def get_cached_document(db, collection: str, document_id) -> dict|None:
+    """
+    Find a document by _id, served from the cache when possible. Documents which don't exist are not cached.
+    :param db: database instance
+    :param collection: vehicles, drivers or users
+    :param document_id: ObjectId of the document
+    :return: copy of the document or None
+    """
+    cache = get_caches()[collection]
+    document = cache.get(document_id)
+    if document is None:
+        generation = cache.generation
+        document = await db[collection].find_one({"_id": document_id})
+        if document is None:
+            return None
+        cache.set(document_id, document, generation)
+    return dict(document)
+
+
+async def invalidate_document(db, collection: str, document_id):
+    """Drop a document from the cache of this worker and, if the channel is enabled, of all other workers"""
+    get_caches()[collection].invalidate(document_id)
+    if get_settings().CACHE_INVALIDATION_CHANNEL:
+        await db[INVALIDATION_COLLECTION].insert_one(
+            {"collection": collection, "document": document_id, "worker": WORKER_ID}
+        )
+
+
+def get_cache_stats() -> dict:
+    return {collection: cache.stats() for collection, cache in get_caches().items()}
+
+
+async def listen_for_invalidations(db):
+    """Tail the invalidation collection and apply the invalidations published by other workers. Runs until cancelled."""
+    try:
+        await db.create_collection(INVALIDATION_COLLECTION, capped=True, size=INVALIDATION_COLLECTION_SIZE)
+    except CollectionInvalid:
+        pass
+    # a tailable cursor on an empty collection is closed immediately, so make sure there is something to start from
+    last = await db[INVALIDATION_COLLECTION].find_one(sort=[("$natural", -1)])
+    if last is None:
+        result = await db[INVALIDATION_COLLECTION].insert_one({"worker": WORKER_ID})
+        last = {"_id": result.inserted_id}
+    last_id = last['_id']
+
+    while True:
+        try:
+            cursor = db[INVALIDATION_COLLECTION].find({"_id": {"$gt": last_id}}, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                async for message in cursor:
+                    last_id = message['_id']
+                    if message.get('worker') != WORKER_ID and message.get('collection') in get_caches():
+                        get_caches()[message['collection']].invalidate(message['document'])
+        except PyMongoError as error:
+            logger.warning("Cache invalidation channel error: %s", error)
+            # entries may have been missed while the cursor was down
+            for cache in get_caches().values():
+                cache.clear()
+        await asyncio.sleep(1)
@@ -0,0 +1,198 @@
+"""Streamed bulk import of vehicles and drivers from CSV or JSON lines uploads.
+
+The upload is read row by row from the request stream and handled in chunks of IMPORT_CHUNK_SIZE rows: every row is
+validated with its schema, duplicates are looked up with one $in query per chunk and the new documents are written
+with one unordered bulk_write. Only the current chunk is held in memory, the report lists the rows which were not
+imported.
+"""
+import codecs
+import csv
+import json
+from collections import deque
+from pydantic import BaseModel, ValidationError
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+
+IMPORT_CHUNK_SIZE = 500
+# rows listed in the report at most, the counts are always complete
+IMPORT_REPORT_LIMIT = 1000
+# lines a quoted csv value may span, a stray quote must not hold back the rest of the upload
+CSV_RECORD_MAX_LINES = 100
+DUPLICATE_KEY_ERROR = 11000
+
+
+async def iter_lines(stream):
+    """Yield the lines of a streamed utf-8 body"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buffer = ""
+    async for chunk in stream:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+class _LineFeed:
+    """Lines handed to csv.reader as they arrive. The reader asks for the next line when it needs one, it stops at the
+    end of what was fed so far and carries on once more is fed"""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def iter_csv_records(stream):
+    """Yield the records of a streamed utf-8 csv body as lists of values. One csv.reader parses the whole body, so a
+    quoted value may contain newlines"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    feed = _LineFeed()
+    reader = csv.reader(feed)
+    buffer = ""
+    # lines of a record which is still inside a quoted value, fed once its closing quote arrived
+    record = []
+    quotes = 0
+    async for chunk in stream:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            record.append(line + "\n")
+            quotes += line.count('"')
+            # an escaped quote is two quotes, so an even count means every quoted value is closed
+            if quotes % 2 == 0 or len(record) >= CSV_RECORD_MAX_LINES:
+                feed.lines.extend(record)
+                record, quotes = [], 0
+        for values in reader:
+            yield values
+    buffer += decoder.decode(b"", final=True)
+    feed.lines.extend(record + ([buffer] if buffer else []))
+    for values in reader:
+        yield values
+
+
+async def iter_rows(stream, file_format: str):
+    """Yield (row number, dict or None if the row can't be parsed) for every non empty row of a csv/jsonl upload"""
+    header = None
+    row_number = 0
+    if file_format == "csv":
+        async for values in iter_csv_records(stream):
+            if not values or len(values) == 1 and not values[0].strip():
+                continue
+            if header is None:
+                header = [value.strip() for value in values]
+                continue
+            row_number += 1
+            if len(values) != len(header):
+                yield row_number, None
+                continue
+            # empty csv cells are missing values
+            yield row_number, {key: value if value != "" else None for key, value in zip(header, values)}
+        return
+
+    async for line in iter_lines(stream):
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield row_number, row if isinstance(row, dict) else None
+
+
+class ImportReport:
+    def __init__(self):
+        self.counts = {"inserted": 0, "duplicate": 0, "invalid": 0, "failed": 0}
+        self.rows = []
+
+    def add(self, row_number: int, status: str, message: str):
+        self.counts[status] += 1
+        if len(self.rows) < IMPORT_REPORT_LIMIT:
+            self.rows.append({"row": row_number, "status": status, "message": message})
+
+    def result(self) -> dict:
+        not_inserted = sum(self.counts.values()) - self.counts['inserted']
+        return {**self.counts, "rows": self.rows, "rows_truncated": not_inserted > len(self.rows)}
+
+
+async def import_chunk(db, collection: str, unique_field: str, chunk: list, report: ImportReport):
+    """Insert a chunk of validated (row number, document) whose *unique_field* is not taken yet"""
+    # duplicates within the chunk and against the database, found with a single query
+    documents = {}
+    for row_number, document in chunk:
+        if document[unique_field] in documents:
+            report.add(row_number, "duplicate", f"Duplicate {unique_field} in upload")
+        else:
+            documents[document[unique_field]] = (row_number, document)
+    existing = set(await db[collection].distinct(unique_field, {unique_field: {"$in": list(documents)}}))
+    for key in existing:
+        row_number, _ = documents.pop(key)
+        report.add(row_number, "duplicate", f"{unique_field} already exists")
+
+    if not documents:
+        return
+    rows = list(documents.values())
+    failed = {}
+    try:
+        await db[collection].bulk_write([InsertOne(document) for _, document in rows], ordered=False)
+    except BulkWriteError as error:
+        failed = {write_error['index']: write_error for write_error in error.details.get('writeErrors', [])}
+
+    for index, (row_number, _) in enumerate(rows):
+        write_error = failed.get(index)
+        if not write_error:
+            report.counts['inserted'] += 1
+        elif write_error.get('code') == DUPLICATE_KEY_ERROR:
+            # inserted concurrently by somebody else
+            report.add(row_number, "duplicate", f"{unique_field} already exists")
+        else:
+            report.add(row_number, "failed", write_error.get('errmsg', "Write failed"))
+
+
+async def import_documents(db, collection: str, schema: type[BaseModel], unique_field: str, stream,
+                           file_format: str) -> dict:
+    """
+    Import a csv/jsonl upload into a collection.
+    :param db: database instance
+    :param collection: collection to insert into
+    :param schema: pydantic model every row is validated with
+    :param unique_field: field identifying duplicates
+    :param stream: async iterator of the upload bytes, e.g. request.stream()
+    :param file_format: csv or jsonl
+    :return: counts of inserted, duplicate, invalid and failed rows and the rows which were not inserted
+    """
+    report = ImportReport()
+    chunk = []
+    async for row_number, row in iter_rows(stream, file_format):
+        if row is None:
+            report.add(row_number, "invalid", "Row can't be parsed")
+            continue
+        try:
+            chunk.append((row_number, schema(**row).model_dump()))
+        except ValidationError as error:
+            report.add(row_number, "invalid", "; ".join(
+                f"{'.'.join(str(part) for part in detail['loc'])}: {detail['msg']}" for detail in error.errors()
+            ))
+            continue
+        if len(chunk) == IMPORT_CHUNK_SIZE:
+            await import_chunk(db, collection, unique_field, chunk, report)
+            chunk = []
+    if chunk:
+        await import_chunk(db, collection, unique_field, chunk, report)
+    return report.result()
+
+
+def get_import_format(file_format: str|None, content_type: str|None) -> str|None:
+    """csv or jsonl from the *format* query param or else the content type, None if it is not supported"""
+    if not file_format:
+        file_format = "csv" if content_type and "csv" in content_type else "jsonl"
+    return file_format if file_format in ("csv", "jsonl") else None
@@ -0,0 +1,120 @@
+"""Request and database metrics in the Prometheus text format.
+
+MetricsMiddleware records count, status and latency of every request per route template, db.monitoring records the
+duration of every MongoDB command. Both end up in the registry below which is rendered at /metrics.
+"""
+import threading
+import time
+from collections import defaultdict
+
+# histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: dict = None) -> str:
+    labels = list(zip(names, values)) + list((extra or {}).items())
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = defaultdict(float)
+        # metrics are also updated from the driver threads of motor
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # per label values: [count per bucket..., count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            values = self._values.setdefault(labels, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[index] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, values in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, values):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, {'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, {'le': '+Inf'})} {values[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {values[-2]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {values[-1]}")
+        return lines
+
+
+http_requests = Counter("http_requests_total", "Number of HTTP requests", ("method", "route", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+mongodb_command_duration = Histogram("mongodb_command_duration_seconds", "MongoDB command duration",
+                                     ("collection", "command"))
+mongodb_command_failures = Counter("mongodb_command_failures_total", "Number of failed MongoDB commands",
+                                   ("collection", "command"))
+registry = [http_requests, http_request_duration, mongodb_command_duration, mongodb_command_failures]
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording count, status code and latency of every request. Requests are labelled by the route
+    template (e.g. /api/vehicles/{id}) so ids in the path don't create a label per request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router stores the matched route in the scope
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_request_duration.observe(time.perf_counter() - started, scope["method"], route)
+            http_requests.inc(scope["method"], route, status)
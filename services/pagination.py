@@ -0,0 +1,78 @@
+"""Keyset pagination and streaming export of whole collections.
+
+Pages are read in _id order starting after the last _id of the previous page, so every page is an index range scan
+regardless of how deep it is. The position is handed to the client as an opaque cursor token.
+"""
+import base64
+import binascii
+import json
+from bson import ObjectId
+from bson.errors import InvalidId
+
+MAX_PAGE_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+
+
+def encode_cursor(last_id: ObjectId) -> str:
+    """Opaque token for the position after *last_id*"""
+    return base64.urlsafe_b64encode(last_id.binary).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> ObjectId|None:
+    """Return the _id a cursor token points after, None if the token is not valid"""
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, InvalidId, TypeError, ValueError):
+        return None
+
+
+def get_projection(fields: str|None) -> dict|None:
+    """Projection for a comma separated list of fields, _id is always returned. None means all fields"""
+    if not fields:
+        return None
+    return {field.strip(): 1 for field in fields.split(",") if field.strip()}
+
+
+def serialize_document(document: dict) -> dict:
+    """Convert the ObjectId values of a document to str so it can be dumped as json"""
+    return {key: str(value) if isinstance(value, ObjectId) else value for key, value in document.items()}
+
+
+def validate_page_params(cursor: str|None, limit: int) -> str|None:
+    """Return an error message if the pagination params are not valid"""
+    if cursor and not decode_cursor(cursor):
+        return "Invalid cursor"
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return f"limit should be between 1 and {MAX_PAGE_SIZE}"
+    return None
+
+
+async def get_page(collection, cursor: str|None, limit: int, fields: str|None) -> dict:
+    """
+    Return one page of a collection as {"items": [...], "next_cursor": token or None}
+    :param collection: motor collection
+    :param cursor: token returned as next_cursor by the previous page, None for the first page
+    :param limit: page size
+    :param fields: comma separated fields to return, None for all fields
+    """
+    query = {}
+    if cursor:
+        query = {"_id": {"$gt": decode_cursor(cursor)}}
+
+    # read one extra document to know whether there is a next page
+    documents = await collection.find(query, get_projection(fields)).sort("_id", 1).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_cursor(documents[limit - 1]['_id']) if len(documents) > limit else None
+    return {"items": [serialize_document(document) for document in documents[:limit]], "next_cursor": next_cursor}
+
+
+async def export_ndjson(collection, fields: str|None, batch_size: int = EXPORT_BATCH_SIZE):
+    """Yield the whole collection as newline delimited json, one chunk per batch so memory stays constant"""
+    cursor = collection.find({}, get_projection(fields)).sort("_id", 1).batch_size(batch_size)
+    lines = []
+    async for document in cursor:
+        lines.append(json.dumps(serialize_document(document), default=str))
+        if len(lines) == batch_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
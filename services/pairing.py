@@ -0,0 +1,74 @@
+"""Batch pairing of free drivers with vehicles which have no driver."""
+from bson import ObjectId
+from services.cache import invalidate_document
+
+
+def _as_object_id(value):
+    # vehicles added through /add keep the driver id as given, as a string
+    return ObjectId(value) if isinstance(value, str) and ObjectId.is_valid(value) else value
+
+
+async def get_free_drivers_and_vehicles(db) -> tuple:
+    """Return (ids of drivers not assigned to any vehicle, ids of vehicles without driver), both in _id order"""
+    assigned = {_as_object_id(driver) for driver in await db['vehicles'].distinct("driver", {"driver": {"$ne": None}})}
+    drivers = [driver['_id'] async for driver in
+               db['drivers'].find({"_id": {"$nin": list(assigned)}}, {"_id": 1}).sort("_id", 1)]
+    vehicles = [vehicle['_id'] async for vehicle in db['vehicles'].find({"driver": None}, {"_id": 1}).sort("_id", 1)]
+    return drivers, vehicles
+
+
+def match_drivers_to_vehicles(drivers: list, vehicles: list, preferences: list, limit: int = 0) -> list:
+    """
+    Pair drivers with vehicles. Preferred (driver, vehicle) pairs are taken first as long as both are still free, the
+    remaining drivers and vehicles are paired in order.
+    :return: list of (driver id, vehicle id)
+    """
+    free_drivers = dict.fromkeys(drivers)
+    free_vehicles = dict.fromkeys(vehicles)
+    pairs = []
+    for driver, vehicle in preferences:
+        if driver in free_drivers and vehicle in free_vehicles:
+            pairs.append((driver, vehicle))
+            del free_drivers[driver], free_vehicles[vehicle]
+    pairs.extend(zip(free_drivers, free_vehicles))
+    return pairs[:limit] if limit else pairs
+
+
+async def auto_pair_drivers(db, preferences: list, limit: int = 0, dry_run: bool = False) -> dict:
+    """
+    Assign free drivers to vehicles without driver. Every assignment is a compare-and-set on its vehicle (only applies
+    if the vehicle still has no driver), pairs whose vehicle got another driver in the meantime are reported as
+    conflicts. A driver who got another vehicle in the meantime is taken back from the new one and reported as
+    conflict as well, so a driver never ends up on two vehicles.
+    :param db: database instance
+    :param preferences: list of preferred (driver id, vehicle id), ObjectIds or their strings
+    :param limit: maximum number of pairs, 0 means no limit
+    :param dry_run: only compute the pairs
+    :return: dict with paired, conflicts and counts of unmatched drivers and vehicles
+    """
+    preferences = [(_as_object_id(driver), _as_object_id(vehicle)) for driver, vehicle in preferences]
+    drivers, vehicles = await get_free_drivers_and_vehicles(db)
+    pairs = match_drivers_to_vehicles(drivers, vehicles, preferences, limit)
+    result = {"unmatched_drivers": len(drivers) - len(pairs), "unmatched_vehicles": len(vehicles) - len(pairs)}
+    if dry_run or not pairs:
+        return {"paired": [{"driver_id": str(driver), "vehicle_id": str(vehicle)} for driver, vehicle in pairs],
+                "conflicts": [], **result}
+
+    paired = []
+    conflicts = []
+    for driver, vehicle in pairs:
+        pair = {"driver_id": str(driver), "vehicle_id": str(vehicle)}
+        assigned = await db['vehicles'].update_one({"_id": vehicle, "driver": None}, {"$set": {"driver": driver}})
+        if not assigned.modified_count:
+            conflicts.append({**pair, "message": "Vehicle got another driver or was removed"})
+            continue
+
+        # the driver may have been assigned to another vehicle since it was read, by id or by its string
+        if await db['vehicles'].count_documents({"_id": {"$ne": vehicle}, "driver": {"$in": [driver, str(driver)]}},
+                                                limit=1):
+            await db['vehicles'].update_one({"_id": vehicle, "driver": driver}, {"$set": {"driver": None}})
+            conflicts.append({**pair, "message": "Driver got assigned to another vehicle"})
+        else:
+            paired.append(pair)
+        await invalidate_document(db, 'vehicles', vehicle)
+    return {"paired": paired, "conflicts": conflicts, **result}
@@ -0,0 +1,293 @@
+"""Daily allocation counters per vehicle, per user and for the whole fleet.
+
+Every allocation adds one to the counter of its vehicle, its user and the fleet on its date, stored in the
+allocation_rollup collection as {generation, kind, key, date, count}. The allocate, update and cancel paths keep the
+counters up to date incrementally and rebuild_rollups recomputes them from the allocation history, archived allocations
+included. Reports read the counters, so their cost depends on the number of days asked for instead of the number of
+allocations, and they keep covering allocations which were moved to the archive.
+
+A rebuild fills a new generation of counters while reports keep reading the active one and switches over at the end.
+Every allocation stores the generation it is counted in (rollup_generation). The rebuild moves allocations into the new
+generation one by one with a compare-and-set and counts the state it set them in, allocations written meanwhile go
+straight into it, and updates and deletes correct the generations the allocation is counted in. So every allocation is
+counted exactly once whatever order the live writes and the rebuild run in.
+
+The counters are rebuilt at startup until a rebuild has completed once, so a database which had allocations before
+the counters existed gets them on its first start. Run `python -m services.rollup` to rebuild the counters by hand.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from pymongo import ReturnDocument, UpdateOne
+from db.lease import HOLDER, hold_lease
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_COLLECTION = "allocation_rollup"
+# {_id: "generation", active, building, last, completed_at}: the generation reports read, the one being rebuilt (or
+# None) and the last one handed out. There is no document before the first rebuild, the active generation is None then
+ROLLUP_STATE_COLLECTION = "allocation_rollup_state"
+GENERATION_FIELD = "rollup_generation"
+# how long a process keeps using the generations it read, a rebuild waits twice as long before it drops the old one
+GENERATION_CACHE_SECONDS = 1
+REBUILD_BATCH_SIZE = 500
+REBUILD_LEASE = "rollup_rebuild"
+FLEET_KEY = "fleet"
+VEHICLE = "vehicle"
+USER = "user"
+FLEET = "fleet"
+
+
+def _rollup_keys(allocation: dict) -> list:
+    """(kind, key, date) of every counter an allocation contributes to"""
+    date = allocation['date']
+    return [(VEHICLE, allocation['vehicle'], date), (USER, allocation['user'], date), (FLEET, FLEET_KEY, date)]
+
+
+async def _get_state(db) -> dict:
+    return await db[ROLLUP_STATE_COLLECTION].find_one({"_id": "generation"}) or {}
+
+
+class Generations:
+    """The active and the building generation of the counters, read again after GENERATION_CACHE_SECONDS. Every
+    writer holds one, a slightly outdated view only costs the rebuild another pass."""
+
+    def __init__(self, db):
+        self.db = db
+        self._generations = (None, None)
+        self._read_at = None
+
+    async def get(self) -> tuple:
+        """(active, building), building is None unless a rebuild runs"""
+        if self._read_at is None or time.monotonic() - self._read_at > GENERATION_CACHE_SECONDS:
+            state = await _get_state(self.db)
+            self._generations = (state.get('active'), state.get('building'))
+            self._read_at = time.monotonic()
+        return self._generations
+
+
+def counted_generations(marker, active) -> list:
+    """Generations an allocation carrying *marker* is counted in: its own and, while that one is being rebuilt, the
+    active generation as well. An allocation behind the active generation is only counted there once a rebuild pass
+    moves it."""
+    if marker is not None and (active is None or marker > active):
+        return [marker, active]
+    return [marker]
+
+
+async def _apply(db, generation, increments: Counter):
+    operations = [
+        UpdateOne({"generation": generation, "kind": kind, "key": key, "date": date}, {"$inc": {"count": amount}},
+                  upsert=True)
+        for (kind, key, date), amount in increments.items() if amount
+    ]
+    if operations:
+        await db[ROLLUP_COLLECTION].bulk_write(operations, ordered=False)
+
+
+async def mark_allocations(generations: Generations, allocations: list):
+    """Set the generation new allocations are counted in, before they are written"""
+    active, building = await generations.get()
+    for allocation in allocations:
+        allocation[GENERATION_FIELD] = active if building is None else building
+
+
+async def record_allocations(generations: Generations, allocations: list, amount: int = 1):
+    """
+    Add (or with amount=-1 remove) allocations to the daily counters of the generations they are counted in, with one
+    bulk write per generation.
+    :param generations: generations of the writer
+    :param allocations: allocation documents with user, vehicle, date and the generation they were marked with
+    :param amount: 1 for new allocations, -1 for cancelled ones
+    """
+    active, _ = await generations.get()
+    increments = {}
+    for allocation in allocations:
+        for generation in counted_generations(allocation.get(GENERATION_FIELD), active):
+            for key in _rollup_keys(allocation):
+                increments.setdefault(generation, Counter())[key] += amount
+    for generation, counts in increments.items():
+        await _apply(generations.db, generation, counts)
+
+
+async def record_allocation_change(generations: Generations, old: dict, new: dict):
+    """Move an updated allocation from the counters of its old vehicle/date to the new ones, *old* is the stored
+    allocation before the update"""
+    active, _ = await generations.get()
+    increments = Counter()
+    for key in _rollup_keys(old):
+        increments[key] -= 1
+    for key in _rollup_keys(new):
+        increments[key] += 1
+    for generation in counted_generations(old.get(GENERATION_FIELD), active):
+        await _apply(generations.db, generation, increments)
+
+
+async def _count_live(db, generation) -> int:
+    """Move every allocation not counted in *generation* yet into it, return how many were moved. The compare-and-set
+    returns the allocation as it is when it is moved, later updates and deletes see the new generation on it."""
+    moved = 0
+    pending = {GENERATION_FIELD: {"$not": {"$gte": generation}}}
+    while True:
+        batch = await db['allocation'].find(pending, {"_id": 1}).limit(REBUILD_BATCH_SIZE).to_list(None)
+        if not batch:
+            return moved
+        allocations = await asyncio.gather(*[
+            db['allocation'].find_one_and_update({"_id": allocation['_id'], **pending},
+                                                 {"$set": {GENERATION_FIELD: generation}},
+                                                 return_document=ReturnDocument.AFTER)
+            for allocation in batch
+        ])
+        increments = Counter()
+        for allocation in allocations:
+            # None if it was deleted or moved by somebody else in the meantime
+            if allocation:
+                increments.update(_rollup_keys(allocation))
+                moved += 1
+        await _apply(db, generation, increments)
+
+
+async def _count_archive(db, generation, months: list):
+    from services.archive import read_archive
+
+    # allocations of an interrupted archive run are still live and counted from there
+    for month in months:
+        live = set(await db['allocation'].distinct("_id", {"date": {"$gte": f"{month}-01", "$lte": f"{month}-31"}}))
+        counts = Counter()
+        for allocation in await asyncio.to_thread(read_archive, month):
+            if allocation['_id'] not in live:
+                counts.update(_rollup_keys(allocation))
+        await _apply(db, generation, counts)
+
+
+async def _rebuild(db, months: list) -> int:
+    state = await db[ROLLUP_STATE_COLLECTION].find_one_and_update(
+        {"_id": "generation"}, {"$inc": {"last": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    generation = state['last']
+    await db[ROLLUP_STATE_COLLECTION].update_one({"_id": "generation"}, {"$set": {"building": generation}})
+
+    await _count_archive(db, generation, months)
+    await _count_live(db, generation)
+    await db[ROLLUP_STATE_COLLECTION].update_one(
+        {"_id": "generation"}, {"$set": {"active": generation, "building": None, "completed_at": datetime.now()}}
+    )
+    # writers which still had the previous generations wrote allocations behind the new one, readers keep reading the
+    # previous counters until they see the switch
+    await asyncio.sleep(GENERATION_CACHE_SECONDS * 2)
+    await _count_live(db, generation)
+    await db[ROLLUP_COLLECTION].delete_many({"generation": {"$ne": generation}})
+    return await db[ROLLUP_COLLECTION].count_documents({"generation": generation})
+
+
+async def rebuild_rollups(db) -> int|None:
+    """
+    Recompute all counters from the archived allocations and the allocation collection into a new generation and make
+    it the active one. Reports keep reading the previous counters while the rebuild runs, allocations are written as
+    usual. Archiving waits for the rebuild. Raises FileNotFoundError, before anything is changed, when the file of an
+    archived month is missing.
+    :param db: database instance
+    :return: number of counters after the rebuild, None if another process is rebuilding
+    """
+    from services.archive import ARCHIVE_LEASE, get_archive_path, get_archived_months
+
+    months = await get_archived_months(db)
+    # the allocations of such a month are only left in its counters, which the rebuild would drop
+    missing = [get_archive_path(month) for month in months if not os.path.exists(get_archive_path(month))]
+    if missing:
+        raise FileNotFoundError(f"Archive files {', '.join(missing)} are missing, allocation rollups not rebuilt")
+
+    # a holder of its own, the leases of this process must keep out a second rebuild and the archiver as well
+    holder = f"{HOLDER}-{uuid.uuid4().hex[:8]}"
+    async with hold_lease(db, REBUILD_LEASE, holder=holder) as acquired:
+        if not acquired:
+            logger.info("Allocation rollups are being rebuilt by another process, skipped")
+            return None
+        # archived allocations are counted from the files and live ones from the collection, so nothing may move
+        # between the two while the rebuild runs
+        while True:
+            async with hold_lease(db, ARCHIVE_LEASE, holder=holder) as archiver_paused:
+                if archiver_paused:
+                    return await _rebuild(db, months)
+            logger.info("Waiting for the archiver to finish before rebuilding the allocation rollups")
+            await asyncio.sleep(5)
+
+
+async def ensure_rollups(db) -> bool:
+    """
+    Rebuild the counters if no rebuild has completed yet, e.g. on the first start after an upgrade. Otherwise count
+    allocations which were written with an outdated generation around the last rebuild. Only one process rebuilds, the
+    others skip it.
+    :param db: database instance
+    :return: whether this call rebuilt the counters
+    """
+    active = (await _get_state(db)).get('active')
+    if active is not None:
+        moved = await _count_live(db, active)
+        if moved:
+            logger.info("Counted %d allocations in the allocation rollups", moved)
+        return False
+
+    logger.info("Rebuilding the allocation rollups")
+    try:
+        count = await rebuild_rollups(db)
+    except FileNotFoundError as error:
+        logger.error("%s, restore them and run `python -m services.rollup`", error)
+        return False
+    if count is None:
+        return False
+    logger.info("Rebuilt %d allocation rollups", count)
+    return True
+
+
+async def count_allocations(db, generation, kind: str, key, start: str, end: str) -> int:
+    """Number of allocations of a vehicle/user between start and end (YYYY-MM-DD, inclusive)"""
+    result = await db[ROLLUP_COLLECTION].aggregate([
+        {"$match": {"generation": generation, "kind": kind, "key": key, "date": {"$gte": start, "$lte": end}}},
+        {"$group": {"_id": None, "count": {"$sum": "$count"}}},
+    ]).to_list(1)
+    return result[0]['count'] if result else 0
+
+
+async def daily_fleet_allocations(db, generation, start: str, end: str) -> dict:
+    """Number of allocations of the whole fleet per date between start and end (YYYY-MM-DD, inclusive)"""
+    cursor = db[ROLLUP_COLLECTION].find(
+        {"generation": generation, "kind": FLEET, "key": FLEET_KEY, "date": {"$gte": start, "$lte": end}}, {"_id": 0, "date": 1, "count": 1}
+    )
+    return {rollup['date']: rollup['count'] async for rollup in cursor}
+
+
+async def top_allocated(db, generation, kind: str, start: str, end: str, limit: int) -> list:
+    """Vehicles/users with the most allocations between start and end, as list of {"key", "count"}"""
+    return await db[ROLLUP_COLLECTION].aggregate([
+        {"$match": {"generation": generation, "kind": kind, "date": {"$gte": start, "$lte": end}}},
+        {"$group": {"_id": "$key", "count": {"$sum": "$count"}}},
+        {"$match": {"count": {"$gt": 0}}},
+        {"$sort": {"count": -1, "_id": 1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "key": "$_id", "count": 1}},
+    ]).to_list(limit)
+
+
+async def allocated_keys(db, generation, kind: str, start: str, end: str) -> list:
+    """Ids of the vehicles/users which have at least one allocation between start and end"""
+    return await db[ROLLUP_COLLECTION].distinct("key", {"generation": generation, "kind": kind,
+                                                        "date": {"$gte": start, "$lte": end}, "count": {"$gt": 0}})
+
+
+async def main():
+    from db.mongodb import MongoDB
+
+    database = MongoDB()
+    await database.connect()
+    count = await rebuild_rollups(database.get_database())
+    print("Another process is rebuilding" if count is None else f"Rebuilt {count} allocation rollups")
+    await database.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
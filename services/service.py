@@ -1,50 +1,282 @@
-from passlib.context import CryptContext
-from datetime import datetime
+import asyncio
+import base64
+import random
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+from starlette.requests import HTTPConnection
+from db.indexes import ensure_indexes
+from services.availability_hub import publish_allocation_changes
+
+ALLOCATION_DATE_FORMAT = "%Y-%m-%d"
+# how many free vehicles are fetched per attempt, a claim picks one of them at random so concurrent requests for the
+# same day do not all race for the very same vehicle
+RESERVATION_CANDIDATES = 20
+# how many vehicles a request tries to claim before it gives up, so a request under heavy contention is not retried
+# for an unbounded time
+RESERVATION_ATTEMPTS = 25
+
+class PasswordHashingBusy(Exception):
+    """Raised when more passwords are waiting to be hashed than PASSWORD_HASH_MAX_PENDING"""
+
+
+@lru_cache
+def get_hash_context():
+    """The passlib context, built on first use (also in every worker process of a process pool)"""
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-hash_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def hash_password(password):
-    return hash_context.hash(password)
+    return get_hash_context().hash(password)
+
+
+class PasswordHasher:
+    """
+    Hashes passwords in a pool so the event loop keeps serving other requests meanwhile. At most *workers* hashes run
+    at once, when *max_pending* calls are already waiting a call is rejected right away instead of growing the queue.
+    The application holds one in app.state.hasher, routes get it with the get_password_hasher dependency.
+    """
+
+    def __init__(self, executor: str = "thread", workers: int = 4, max_pending: int = 64):
+        self.executor = executor
+        self.workers = workers
+        self.max_pending = max_pending
+        # the pool is only created on the first hash
+        self._executor = None
+        self._slots = None
+        self._pending = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.executor == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+            self._slots = asyncio.Semaphore(self.workers)
+        return self._executor
+
+    async def hash(self, password) -> str:
+        """
+        Hash a password in the pool. Raises PasswordHashingBusy when too many calls are waiting.
+        :param password: plain password
+        :return: password hash
+        """
+        if self._pending >= self.max_pending:
+            raise PasswordHashingBusy()
+
+        executor = self._get_executor()
+        self._pending += 1
+        try:
+            async with self._slots:
+                return await asyncio.get_running_loop().run_in_executor(executor, hash_password, password)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._slots = None
 
 
-async def get_free_vehicle_on_given_day(date: datetime.date, db) -> dict|None:
+def get_password_hasher(connection: HTTPConnection) -> PasswordHasher:
+    """Dependency returning the password hasher of the application"""
+    return connection.app.state.hasher
+
+
+async def ensure_allocation_indexes(db):
+    """Create the indexes of the allocation collection. The unique (date, vehicle) index answers the availability of a
+    day from that day's entries only and makes the database reject a second allocation of a vehicle on the same day."""
+    await ensure_indexes(db, collections=["allocation"])
+
+
+async def get_allocated_vehicles_on_given_day(date: datetime.date, storage) -> list:
+    """
+    Return the ids of all vehicles that are already allocated on the given date. It is answered from the date index of
+    the allocations so the cost depends on the allocations of that day only, not on the size of the allocation history.
+    :param storage: storage backend
+    :param date: which day to check
+    :return: list of vehicle ids
+    """
+    return await storage.allocations.vehicles_on(date.strftime(ALLOCATION_DATE_FORMAT))
+
+
+async def get_free_vehicles_on_given_day(date: datetime.date, storage, limit: int = 0, exclude: list = None) -> list:
+    """
+    Return ids of vehicles that are free on the given date, in _id order.
+    :param storage: storage backend
+    :param date: which day to check for free vehicles
+    :param limit: maximum number of vehicles to return, 0 means all
+    :param exclude: vehicle ids that should be treated as busy in addition to the allocated ones
+    :return: list of vehicle ids
+    """
+    allocated_vehicles = await get_allocated_vehicles_on_given_day(date, storage)
+    if exclude:
+        allocated_vehicles.extend(exclude)
+
+    vehicles = await storage.vehicles.find(exclude=allocated_vehicles, limit=limit, fields=[])
+    return [vehicle['_id'] for vehicle in vehicles]
+
+
+async def get_free_vehicle_on_given_day(date: datetime.date, storage) -> dict|None:
     """
     This function will return a vehicle that is free on the given date. It will return None if no vehicle is free on that
     day.
-    :param db: database instance
+    :param storage: storage backend
     :param date: which day to check for free vehicle
     :return: dict
     """
-    pipeline = [
-        {
-            "$lookup": {
-                "from": "allocation",  # The 'allocations' collection
-                "localField": "_id",  # _id from 'vehicles'
-                "foreignField": "vehicle",  # vehicle_id from 'allocations'
-                "as": "allocation"  # Resulting array field to store allocations
-            }
-        },
-        {
-            "$match": {
-                "$or": [
-                    { "allocation": { "$size": 0 } },  # Match vehicles with no allocations
-                    { "allocation.date": { "$ne": date.strftime("%Y-%m-%d") } }  # Exclude vehicles allocated on the specific date
-                ]
-            }
-        },
-        {"$limit": 1 },
-        {
-            "$project": {
-                "_id": 1
-            }
-        }
-
-    ]
-
-    # check if any vehicle is available for allocation on that day
+    free_vehicles = await get_free_vehicles_on_given_day(date, storage, limit=1)
+    return {"_id": free_vehicles[0]} if free_vehicles else None
+
+
+async def get_availability_matrix(start: datetime.date, days: int, storage) -> dict:
+    """
+    Free/busy status of every vehicle on every day of a date range, computed from one range query over the date index
+    of the allocations. The status is a bitset with one row of *days* bits per vehicle (in the order of *vehicles*),
+    bit vehicle * days + day is set when the vehicle is allocated on that day, most significant bit first. The bitset
+    is zlib compressed and base64 encoded.
+    :param storage: storage backend
+    :param start: first day of the range
+    :param days: number of days in the range
+    :return: dict with vehicles, free vehicles per day and the encoded matrix
+    """
+    vehicles = [vehicle['_id'] for vehicle in await storage.vehicles.find(fields=[])]
+    rows = {vehicle_id: row for row, vehicle_id in enumerate(vehicles)}
+    end = start + timedelta(days=days - 1)
+
+    matrix = bytearray((len(vehicles) * days + 7) // 8)
+    busy_per_day = [0] * days
+    allocations = await storage.allocations.between(start.strftime(ALLOCATION_DATE_FORMAT),
+                                                    end.strftime(ALLOCATION_DATE_FORMAT))
+    for allocation in allocations:
+        row = rows.get(allocation['vehicle'])
+        if row is None:
+            continue
+        day = (datetime.strptime(allocation['date'], ALLOCATION_DATE_FORMAT).date() - start).days
+        bit = row * days + day
+        matrix[bit // 8] |= 0x80 >> (bit % 8)
+        busy_per_day[day] += 1
+
+    return {
+        "vehicles": [str(vehicle_id) for vehicle_id in vehicles],
+        "free": [len(vehicles) - busy for busy in busy_per_day],
+        "matrix": base64.b64encode(zlib.compress(bytes(matrix))).decode(),
+    }
+
+
+async def claim_free_vehicle_on_given_day(date: datetime.date, storage, claim) -> dict|None:
+    """
+    Find a free vehicle on the given date and hand it to *claim*, an async callable that writes the allocation for that
+    vehicle. The unique (date, vehicle) key makes the write itself the reservation: if another request took the
+    vehicle in the meantime the write fails with a duplicate key error, the free vehicles are fetched again without the
+    vehicles lost so far and another one is tried. There is no lock, so concurrent requests only retry when they
+    actually collide, and every collision means another request got a vehicle. None is returned once a fresh fetch
+    finds no free vehicle or after RESERVATION_ATTEMPTS collisions.
+    :param storage: storage backend
+    :param date: which day to allocate
+    :param claim: async callable receiving a vehicle id, it must raise DuplicateKeyError if the vehicle is taken
+    :return: dict with the claimed vehicle id or None if no vehicle could be claimed
+    """
+    taken = []
+    for _ in range(RESERVATION_ATTEMPTS):
+        # fetched again after every collision, the candidates of a previous attempt are likely taken by now as well
+        candidates = await get_free_vehicles_on_given_day(date, storage, limit=RESERVATION_CANDIDATES, exclude=taken)
+        if not candidates:
+            return None
+
+        vehicle_id = random.choice(candidates)
+        try:
+            await claim(vehicle_id)
+            return {"_id": vehicle_id}
+        except DuplicateKeyError:
+            # somebody else got this vehicle first, it is left out of the next fetch
+            taken.append(vehicle_id)
+    return None
+
+
+class _RequestAllocated(Exception):
+    """The queued request of an allocation already has an allocation"""
+
+
+def _is_duplicate_request(error: DuplicateKeyError) -> bool:
+    """Whether *error* comes from the unique request index instead of the (date, vehicle) key"""
+    return "request" in (error.details or {}).get("keyPattern", {})
+
+
+async def reserve_vehicle_on_given_day(user_id, date: datetime.date, storage, extra: dict = None) -> dict|None:
+    """
+    Allocate a free vehicle to the user on the given date.
+    :param storage: storage backend
+    :param user_id: ObjectId of the user
+    :param date: which day to allocate
+    :param extra: additional fields stored with the allocation
+    :return: the inserted allocation or None if no vehicle is available or its queued request (extra "request") was
+    already allocated
+    """
+    allocation = {}
+
+    async def claim(vehicle_id):
+        allocation.clear()
+        allocation.update({"user": user_id, "vehicle": vehicle_id, "date": date.strftime(ALLOCATION_DATE_FORMAT)})
+        allocation.update(extra or {})
+        try:
+            await storage.allocations.add(allocation)
+        except DuplicateKeyError as error:
+            if _is_duplicate_request(error):
+                raise _RequestAllocated() from error
+            raise
+
     try:
-        available_vehicles = await db['vehicles'].aggregate(pipeline).next()
-        print(available_vehicles)
-        return available_vehicles
-    except StopAsyncIteration:
+        vehicle = await claim_free_vehicle_on_given_day(date, storage, claim)
+    except _RequestAllocated:
+        # another worker allocated this queued request, trying other vehicles would fail the same way
+        return None
+    if not vehicle:
         return None
+    publish_allocation_changes([allocation])
+    return allocation
+
+
+async def allocate_vehicles(bookings: list, storage, extra: list = None) -> list:
+    """
+    Allocate vehicles for many (user id, date) bookings at once. Availability is computed once per distinct date and all
+    allocations are written with a single add_many. Bookings whose vehicle was taken by a concurrent request in the
+    meantime fall back to reserve_vehicle_on_given_day.
+    :param storage: storage backend
+    :param bookings: list of (user ObjectId, date) tuples, already validated
+    :param extra: additional fields stored with the allocation of every booking, in the same order as bookings
+    :return: list with the inserted allocation or None (no vehicle available) for every booking, in the same order
+    """
+    results = [None] * len(bookings)
+    bookings_by_date = {}
+    for index, (user_id, date) in enumerate(bookings):
+        bookings_by_date.setdefault(date, []).append(index)
+
+    allocations = []
+    positions = []
+    for date, indexes in bookings_by_date.items():
+        free_vehicles = await get_free_vehicles_on_given_day(date, storage, limit=len(indexes))
+        for index, vehicle_id in zip(indexes, free_vehicles):
+            user_id = bookings[index][0]
+            allocations.append({"user": user_id, "vehicle": vehicle_id, "date": date.strftime(ALLOCATION_DATE_FORMAT),
+                                **(extra[index] if extra else {})})
+            positions.append(index)
+
+    if not allocations:
+        return results
+
+    failed = await storage.allocations.add_many(allocations)
+    publish_allocation_changes([allocation for offset, allocation in enumerate(allocations) if offset not in failed])
+    for offset, (index, allocation) in enumerate(zip(positions, allocations)):
+        if offset in failed:
+            # the vehicle was booked concurrently, retry this booking on its own
+            user_id, date = bookings[index]
+            results[index] = await reserve_vehicle_on_given_day(user_id, date, storage, extra[index] if extra else None)
+        else:
+            results[index] = allocation
+    return results
@@ -0,0 +1,138 @@
+"""Repositories of the allocation domain: vehicles, drivers, users and allocations.
+
+Routers and services go through a Storage instead of Motor collections, so the same code runs on every backend:
+- mongo (storage.mongo): the MongoDB collections, with the read-through cache and the allocation rollups
+- memory (storage.memory): everything in the process with hash and date indexes, nothing is persisted
+
+Ids are ObjectIds and allocation dates YYYY-MM-DD strings on every backend. A write which breaks a unique key (a
+registration number, license number, email or a vehicle booked twice on a day) raises pymongo's DuplicateKeyError on
+every backend, so callers handle it the same way. `python -m storage.conformance` checks a backend against this
+contract.
+"""
+from abc import ABC, abstractmethod
+from fastapi import HTTPException
+from starlette.requests import HTTPConnection
+
+
+class Repository(ABC):
+    @abstractmethod
+    async def get(self, document_id) -> dict|None:
+        """Document with the given _id or None"""
+
+    @abstractmethod
+    async def add(self, document: dict):
+        """Store a document, its _id is set on *document* and returned. Raises DuplicateKeyError"""
+
+    @abstractmethod
+    async def add_many(self, documents: list) -> set:
+        """Store many documents, a failed one does not stop the others. _id is set on every document, return the
+        indexes of the documents which were not stored"""
+
+
+class VehicleRepository(Repository):
+    @abstractmethod
+    async def get_by_registration_number(self, registration_number: str) -> dict|None: ...
+
+    @abstractmethod
+    async def get_by_driver(self, driver_id) -> dict|None:
+        """Vehicle the driver is assigned to"""
+
+    @abstractmethod
+    async def list(self, skip: int, limit: int) -> list: ...
+
+    @abstractmethod
+    async def count(self) -> int: ...
+
+    @abstractmethod
+    async def find(self, exclude: list = None, limit: int = 0, fields: list = None) -> list:
+        """
+        Vehicles in _id order.
+        :param exclude: ids of vehicles to leave out
+        :param limit: maximum number of vehicles, 0 means all
+        :param fields: fields to return besides _id, all if None
+        """
+
+    @abstractmethod
+    async def assign_driver(self, vehicle_id, driver_id, current=None) -> bool:
+        """Set the driver of a vehicle if its driver is still *current*, return whether it was set"""
+
+    @abstractmethod
+    async def unassign_driver(self, driver_id):
+        """Remove the driver from its vehicle, return the id of that vehicle or None"""
+
+
+class DriverRepository(Repository):
+    @abstractmethod
+    async def get_by_license_number(self, license_number: str) -> dict|None: ...
+
+    @abstractmethod
+    async def list(self, skip: int, limit: int) -> list: ...
+
+
+class UserRepository(Repository):
+    @abstractmethod
+    async def get_by_email(self, email: str) -> dict|None: ...
+
+    @abstractmethod
+    async def existing_ids(self, user_ids: list) -> set:
+        """The ids out of *user_ids* which belong to a user"""
+
+
+class AllocationRepository(Repository):
+    """Allocations are {user, vehicle, date} and unique per (date, vehicle). The per vehicle, per user and fleet
+    counters the reports read are kept up to date by add, add_many, update and delete."""
+
+    @abstractmethod
+    async def update(self, allocation: dict, fields: dict) -> bool:
+        """Set *fields* on a stored *allocation*, return whether it still existed. Raises DuplicateKeyError when the
+        new (date, vehicle) is already taken"""
+
+    @abstractmethod
+    async def delete(self, allocation: dict) -> bool:
+        """Remove a stored *allocation*, return whether it was removed by this call"""
+
+    @abstractmethod
+    async def vehicles_on(self, date: str) -> list:
+        """Ids of the vehicles allocated on a date"""
+
+    @abstractmethod
+    async def between(self, start: str, end: str) -> list:
+        """{date, vehicle} of every allocation between start and end (inclusive)"""
+
+    @abstractmethod
+    async def count(self, kind: str, key, start: str, end: str) -> int:
+        """Number of allocations of a vehicle/user (kind VEHICLE/USER of services.rollup) between start and end"""
+
+    @abstractmethod
+    async def daily_counts(self, start: str, end: str) -> dict:
+        """Number of allocations of the whole fleet per date between start and end, dates without any are left out"""
+
+    @abstractmethod
+    async def top(self, kind: str, start: str, end: str, limit: int) -> list:
+        """Vehicles/users with the most allocations between start and end as list of {"key", "count"}, most first
+        and by key on a tie"""
+
+    @abstractmethod
+    async def keys(self, kind: str, start: str, end: str) -> list:
+        """Ids of the vehicles/users with at least one allocation between start and end"""
+
+
+class Storage(ABC):
+    vehicles: VehicleRepository
+    drivers: DriverRepository
+    users: UserRepository
+    allocations: AllocationRepository
+    # Motor database behind the storage, for the features which only exist on MongoDB. None on other backends
+    database = None
+
+    @abstractmethod
+    async def ping(self) -> float:
+        """Round trip to the backend in ms"""
+
+
+def get_storage(connection: HTTPConnection) -> Storage:
+    """Dependency returning the storage of the application, 503 while it is not set up"""
+    storage = connection.app.state.storage
+    if storage is None:
+        raise HTTPException(status_code=503, detail="Database not connected")
+    return storage
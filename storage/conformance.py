@@ -0,0 +1,388 @@
+"""Conformance checks of the storage backends. Every backend has to pass the same checks, they cover the contract of
+storage.base: unique keys raising DuplicateKeyError, driver assignment as compare and set, the (date, vehicle) key of
+allocations, range queries and the report counters, and concurrent reservations through services.service, also with
+the calls of the requests interleaved. On MongoDB the report counters also have to stay exact while they are rebuilt.
+
+Every check runs against a fresh, empty storage. The mongo backend uses a scratch database which is dropped afterwards.
+
+Usage:
+    python -m storage.conformance --backend memory
+    DATABASE_URL=mongodb://localhost:27017 python -m storage.conformance --backend mongo
+"""
+import argparse
+import asyncio
+import os
+import sys
+import traceback
+from collections import Counter
+from datetime import date, timedelta
+
+os.environ.setdefault("DATABASE_URL", "mongodb://localhost:27017")
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from services.rollup import USER, VEHICLE, rebuild_rollups
+from services.service import ALLOCATION_DATE_FORMAT, allocate_vehicles, reserve_vehicle_on_given_day
+
+CHECKS = []
+
+
+def check(function):
+    CHECKS.append(function)
+    return function
+
+
+async def raises_duplicate(write) -> bool:
+    try:
+        await write
+    except DuplicateKeyError:
+        return True
+    return False
+
+
+class Interleaved:
+    """Storage wrapper which yields to the event loop before and after every repository call, so concurrent requests
+    interleave on every backend. The memory backend never yields by itself, all calls of one request would otherwise
+    run before the next request starts."""
+
+    class Repository:
+        def __init__(self, repository):
+            self.repository = repository
+
+        def __getattr__(self, name):
+            method = getattr(self.repository, name)
+
+            async def call(*args, **kwargs):
+                await asyncio.sleep(0)
+                result = await method(*args, **kwargs)
+                await asyncio.sleep(0)
+                return result
+
+            return call
+
+    def __init__(self, storage):
+        self.vehicles = self.Repository(storage.vehicles)
+        self.drivers = self.Repository(storage.drivers)
+        self.users = self.Repository(storage.users)
+        self.allocations = self.Repository(storage.allocations)
+        self.database = storage.database
+
+
+def day(offset: int) -> str:
+    return (date(2030, 1, 1) + timedelta(days=offset)).strftime(ALLOCATION_DATE_FORMAT)
+
+
+async def add_vehicles(storage, count: int) -> list:
+    return [await storage.vehicles.add({"registration_number": f"CONF-{i}", "model": "conformance", "driver": None})
+            for i in range(count)]
+
+
+@check
+async def vehicles(storage):
+    vehicle = {"registration_number": "CONF-1", "model": "conformance", "driver": None}
+    vehicle_id = await storage.vehicles.add(vehicle)
+    assert vehicle['_id'] == vehicle_id
+    assert (await storage.vehicles.get(vehicle_id))['registration_number'] == "CONF-1"
+    assert (await storage.vehicles.get_by_registration_number("CONF-1"))['_id'] == vehicle_id
+    assert await storage.vehicles.get(ObjectId()) is None
+    assert await storage.vehicles.get_by_registration_number("CONF-2") is None
+    assert await raises_duplicate(storage.vehicles.add({"registration_number": "CONF-1", "model": "other"}))
+    assert await storage.vehicles.count() == 1
+
+    # a returned document is a copy
+    (await storage.vehicles.get(vehicle_id))['model'] = "changed"
+    assert (await storage.vehicles.get(vehicle_id))['model'] == "conformance"
+
+
+@check
+async def vehicles_in_id_order(storage):
+    vehicle_ids = await add_vehicles(storage, 5)
+    assert [vehicle['_id'] for vehicle in await storage.vehicles.find()] == sorted(vehicle_ids)
+    assert [vehicle['_id'] for vehicle in await storage.vehicles.find(limit=2)] == sorted(vehicle_ids)[:2]
+    excluded = sorted(vehicle_ids)[1:3]
+    assert ([vehicle['_id'] for vehicle in await storage.vehicles.find(exclude=excluded)]
+            == [vehicle_id for vehicle_id in sorted(vehicle_ids) if vehicle_id not in excluded])
+    assert all(set(vehicle) == {"_id"} for vehicle in await storage.vehicles.find(fields=[]))
+    assert all(set(vehicle) == {"_id", "registration_number"}
+               for vehicle in await storage.vehicles.find(fields=["registration_number"]))
+    assert len(await storage.vehicles.list(0, 3)) == 3
+    assert len(await storage.vehicles.list(3, 3)) == 2
+
+
+@check
+async def add_many(storage):
+    vehicles = [{"registration_number": f"CONF-{i % 3}", "model": "conformance", "driver": None} for i in range(5)]
+    assert await storage.vehicles.add_many(vehicles) == {3, 4}
+    assert all('_id' in vehicle for vehicle in vehicles)
+    assert await storage.vehicles.count() == 3
+    assert await storage.vehicles.add_many([]) == set()
+
+
+@check
+async def driver_assignment(storage):
+    vehicle_ids = await add_vehicles(storage, 2)
+    driver_id = await storage.drivers.add({"name": "Driver", "license_number": "CONF-L-1"})
+    assert await storage.vehicles.get_by_driver(driver_id) is None
+
+    assert await storage.vehicles.assign_driver(vehicle_ids[0], driver_id)
+    # compare and set, the vehicle has a driver now
+    assert not await storage.vehicles.assign_driver(vehicle_ids[0], ObjectId())
+    assert (await storage.vehicles.get(vehicle_ids[0]))['driver'] == driver_id
+    assert (await storage.vehicles.get_by_driver(driver_id))['_id'] == vehicle_ids[0]
+    assert not await storage.vehicles.assign_driver(ObjectId(), driver_id)
+
+    assert await storage.vehicles.unassign_driver(driver_id) == vehicle_ids[0]
+    assert await storage.vehicles.unassign_driver(driver_id) is None
+    assert (await storage.vehicles.get(vehicle_ids[0]))['driver'] is None
+    assert await storage.vehicles.get_by_driver(driver_id) is None
+
+
+@check
+async def drivers(storage):
+    driver_id = await storage.drivers.add({"name": "Driver", "license_number": "CONF-L-1"})
+    assert (await storage.drivers.get(driver_id))['name'] == "Driver"
+    assert (await storage.drivers.get_by_license_number("CONF-L-1"))['_id'] == driver_id
+    assert await storage.drivers.get_by_license_number("CONF-L-2") is None
+    assert await raises_duplicate(storage.drivers.add({"name": "Other", "license_number": "CONF-L-1"}))
+    assert [driver['_id'] for driver in await storage.drivers.list(0, 10)] == [driver_id]
+
+
+@check
+async def users(storage):
+    user = {"name": "User", "email": "user@conformance.test", "password": "hash"}
+    user_id = await storage.users.add(user)
+    assert user['_id'] == user_id
+    assert (await storage.users.get(user_id))['email'] == "user@conformance.test"
+    assert (await storage.users.get_by_email("user@conformance.test"))['_id'] == user_id
+    assert await storage.users.get_by_email("other@conformance.test") is None
+    assert await raises_duplicate(storage.users.add({"name": "Other", "email": "user@conformance.test"}))
+    assert await storage.users.existing_ids([user_id, ObjectId()]) == {user_id}
+    assert await storage.users.existing_ids([]) == set()
+
+
+@check
+async def allocation_key(storage):
+    vehicle_id, other_vehicle_id = await add_vehicles(storage, 2)
+    user_id = ObjectId()
+    allocation = {"user": user_id, "vehicle": vehicle_id, "date": day(0)}
+    allocation_id = await storage.allocations.add(allocation)
+    assert allocation['_id'] == allocation_id
+    assert (await storage.allocations.get(allocation_id))['vehicle'] == vehicle_id
+    assert await storage.allocations.get(ObjectId()) is None
+
+    assert await raises_duplicate(storage.allocations.add({"user": ObjectId(), "vehicle": vehicle_id, "date": day(0)}))
+    await storage.allocations.add({"user": user_id, "vehicle": vehicle_id, "date": day(1)})
+    await storage.allocations.add({"user": user_id, "vehicle": other_vehicle_id, "date": day(0)})
+    assert sorted(await storage.allocations.vehicles_on(day(0))) == sorted([vehicle_id, other_vehicle_id])
+    assert await storage.allocations.vehicles_on(day(1)) == [vehicle_id]
+    assert await storage.allocations.vehicles_on(day(2)) == []
+
+    allocations = [{"user": user_id, "vehicle": vehicle_id, "date": day(2)},
+                   {"user": user_id, "vehicle": vehicle_id, "date": day(0)},
+                   {"user": user_id, "vehicle": vehicle_id, "date": day(2)}]
+    assert await storage.allocations.add_many(allocations) == {1, 2}
+    assert await storage.allocations.vehicles_on(day(2)) == [vehicle_id]
+
+
+@check
+async def allocation_update_and_delete(storage):
+    vehicle_id, other_vehicle_id = await add_vehicles(storage, 2)
+    user_id = ObjectId()
+    allocation = {"user": user_id, "vehicle": vehicle_id, "date": day(0)}
+    await storage.allocations.add(allocation)
+    await storage.allocations.add({"user": user_id, "vehicle": other_vehicle_id, "date": day(1)})
+
+    # moving onto a taken (date, vehicle) fails and leaves the allocation as it was
+    assert await raises_duplicate(storage.allocations.update(allocation, {"vehicle": other_vehicle_id, "date": day(1)}))
+    assert (await storage.allocations.get(allocation['_id']))['date'] == day(0)
+    assert await storage.allocations.vehicles_on(day(0)) == [vehicle_id]
+
+    assert await storage.allocations.update(allocation, {"date": day(1)})
+    assert (await storage.allocations.get(allocation['_id']))['date'] == day(1)
+    assert await storage.allocations.vehicles_on(day(0)) == []
+    assert await storage.allocations.count(VEHICLE, vehicle_id, day(0), day(0)) == 0
+    assert await storage.allocations.count(VEHICLE, vehicle_id, day(1), day(1)) == 1
+    assert await storage.allocations.count(USER, user_id, day(0), day(1)) == 2
+
+    allocation = await storage.allocations.get(allocation['_id'])
+    assert await storage.allocations.delete(allocation)
+    assert not await storage.allocations.delete(allocation)
+    assert not await storage.allocations.update(allocation, {"date": day(2)})
+    assert await storage.allocations.get(allocation['_id']) is None
+    assert await storage.allocations.vehicles_on(day(1)) == [other_vehicle_id]
+    assert await storage.allocations.count(USER, user_id, day(0), day(1)) == 1
+
+
+@check
+async def allocation_ranges_and_reports(storage):
+    vehicle_ids = sorted(await add_vehicles(storage, 3))
+    user_ids = sorted([ObjectId(), ObjectId()])
+    # vehicle 0 on days 0-3, vehicle 1 on days 1-2, vehicle 2 never
+    bookings = [(0, 0, 0), (0, 1, 1), (0, 0, 2), (0, 1, 3), (1, 0, 1), (1, 0, 2)]
+    await storage.allocations.add_many([{"user": user_ids[user], "vehicle": vehicle_ids[vehicle], "date": day(offset)}
+                                        for vehicle, user, offset in bookings])
+
+    between = await storage.allocations.between(day(1), day(2))
+    assert sorted((allocation['date'], allocation['vehicle']) for allocation in between) == sorted(
+        [(day(1), vehicle_ids[0]), (day(1), vehicle_ids[1]), (day(2), vehicle_ids[0]), (day(2), vehicle_ids[1])])
+    assert await storage.allocations.between(day(5), day(9)) == []
+
+    assert await storage.allocations.count(VEHICLE, vehicle_ids[0], day(0), day(3)) == 4
+    assert await storage.allocations.count(VEHICLE, vehicle_ids[0], day(1), day(2)) == 2
+    assert await storage.allocations.count(VEHICLE, vehicle_ids[2], day(0), day(3)) == 0
+    assert await storage.allocations.count(USER, user_ids[0], day(0), day(3)) == 4
+    assert await storage.allocations.daily_counts(day(0), day(5)) == {day(0): 1, day(1): 2, day(2): 2, day(3): 1}
+
+    assert await storage.allocations.top(VEHICLE, day(0), day(3), 10) == [
+        {"key": vehicle_ids[0], "count": 4}, {"key": vehicle_ids[1], "count": 2}]
+    assert await storage.allocations.top(USER, day(0), day(3), 1) == [{"key": user_ids[0], "count": 4}]
+    # a tie is ordered by key
+    assert await storage.allocations.top(USER, day(1), day(1), 10) == [
+        {"key": user_ids[0], "count": 1}, {"key": user_ids[1], "count": 1}]
+
+    assert sorted(await storage.allocations.keys(VEHICLE, day(3), day(3))) == [vehicle_ids[0]]
+    assert sorted(await storage.allocations.keys(VEHICLE, day(0), day(3))) == vehicle_ids[:2]
+    assert await storage.allocations.keys(USER, day(5), day(9)) == []
+
+
+@check
+async def concurrent_reservations(storage):
+    vehicle_ids = await add_vehicles(storage, 10)
+    booking_day = date(2030, 1, 1)
+    results = await asyncio.gather(*[reserve_vehicle_on_given_day(ObjectId(), booking_day, storage) for _ in range(25)])
+    allocated = [result['vehicle'] for result in results if result]
+    assert sorted(allocated) == sorted(vehicle_ids), "every vehicle is allocated exactly once"
+    assert len(await storage.allocations.vehicles_on(booking_day.strftime(ALLOCATION_DATE_FORMAT))) == 10
+
+
+@check
+async def interleaved_reservations(storage):
+    # every request sees the same free vehicles at first, the losers of a collision have to look further
+    vehicle_ids = await add_vehicles(storage, 50)
+    booking_day = date(2030, 1, 1)
+    storage = Interleaved(storage)
+    results = await asyncio.gather(*[reserve_vehicle_on_given_day(ObjectId(), booking_day, storage) for _ in range(60)])
+    allocated = [result['vehicle'] for result in results if result]
+    assert sorted(allocated) == sorted(vehicle_ids), f"{len(allocated)} of {len(vehicle_ids)} vehicles allocated"
+    assert sum(not result for result in results) == 10
+
+
+@check
+async def bulk_allocation(storage):
+    await add_vehicles(storage, 3)
+    user_id = ObjectId()
+    first_day = date(2030, 1, 1)
+    second_day = date(2030, 1, 2)
+    results = await allocate_vehicles([(user_id, first_day)] * 4 + [(user_id, second_day)], storage)
+    assert [bool(result) for result in results] == [True, True, True, False, True]
+    assert len({result['vehicle'] for result in results[:3]}) == 3
+    assert await storage.allocations.count(USER, user_id, day(0), day(1)) == 4
+
+
+@check
+async def allocations_during_rollup_rebuild(storage):
+    # only MongoDB keeps counters which can be rebuilt
+    if storage.database is None:
+        return
+    vehicle_ids = await add_vehicles(storage, 5)
+    user_ids = [ObjectId(), ObjectId()]
+    await storage.allocations.add_many([{"user": user_ids[offset % 2], "vehicle": vehicle_id, "date": day(offset)}
+                                        for offset in range(20) for vehicle_id in vehicle_ids])
+
+    # allocate, move and cancel while the rebuild counts, until it has switched over and dropped the old counters
+    rebuild = asyncio.create_task(rebuild_rollups(storage.database))
+    interleaved = Interleaved(storage)
+    step = 0
+    while not rebuild.done():
+        vehicle_id = vehicle_ids[step % len(vehicle_ids)]
+        allocation = {"user": user_ids[step % 2], "vehicle": vehicle_id, "date": day(100 + step)}
+        await interleaved.allocations.add(allocation)
+        moved = await storage.allocations.get(allocation['_id'])
+        await interleaved.allocations.update(moved, {"date": day(1000 + step)})
+        cancelled = await storage.database['allocation'].find_one({"date": day(step % 20)})
+        if step % 3 == 0 and cancelled:
+            await interleaved.allocations.delete(cancelled)
+        step += 1
+        await asyncio.sleep(0.01)
+    assert await rebuild > 0
+
+    allocations = await storage.allocations.between(day(0), day(2000))
+    assert await storage.allocations.daily_counts(day(0), day(2000)) == Counter(
+        allocation['date'] for allocation in allocations)
+    for vehicle_id in vehicle_ids:
+        assert await storage.allocations.count(VEHICLE, vehicle_id, day(0), day(2000)) == sum(
+            allocation['vehicle'] == vehicle_id for allocation in allocations)
+    for user_id in user_ids:
+        assert await storage.allocations.count(USER, user_id, day(0), day(2000)) == \
+            await storage.database['allocation'].count_documents({"user": user_id})
+
+
+def memory_backend():
+    from storage.memory import MemoryStorage
+
+    async def make_storage():
+        return MemoryStorage()
+
+    async def cleanup():
+        pass
+
+    return make_storage, cleanup
+
+
+def mongo_backend(database: str):
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from db.indexes import ensure_indexes
+    from storage.mongo import MongoStorage
+
+    client = AsyncIOMotorClient(os.environ["DATABASE_URL"])
+
+    async def make_storage():
+        await client.drop_database(database)
+        db = client.get_database(database)
+        await ensure_indexes(db)
+        return MongoStorage(db)
+
+    async def cleanup():
+        await client.drop_database(database)
+        client.close()
+
+    return make_storage, cleanup
+
+
+async def run_checks(backend: str, database: str) -> int:
+    """Run every check against the backend, return the number of failed checks"""
+    make_storage, cleanup = memory_backend() if backend == "memory" else mongo_backend(database)
+    failed = 0
+    try:
+        for conformance_check in CHECKS:
+            storage = await make_storage()
+            try:
+                await conformance_check(storage)
+            except Exception:
+                failed += 1
+                print(f"FAIL {backend} {conformance_check.__name__}")
+                traceback.print_exc()
+            else:
+                print(f"ok   {backend} {conformance_check.__name__}")
+    finally:
+        await cleanup()
+    return failed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["memory", "mongo", "all"], default="memory")
+    parser.add_argument("--database", default="storage_conformance")
+    args = parser.parse_args()
+
+    backends = ["memory", "mongo"] if args.backend == "all" else [args.backend]
+    failed = 0
+    for backend in backends:
+        failed += await run_checks(backend, args.database)
+    print(f"{len(CHECKS) * len(backends) - failed} passed, {failed} failed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,271 @@
+"""In-memory backend of the repositories, for tests and load runs without MongoDB and to try a faster store for the
+availability lookups. Nothing is persisted and every process has its own data, so it is meant for a single worker.
+
+Documents are kept in dicts by _id with hash indexes on the unique keys (registration number, license number, email)
+and on the driver of a vehicle. Allocations are indexed by date, vehicle per date, with a sorted list of the dates for
+range queries, plus daily counters per vehicle and per user. All methods run without awaiting anything, so every call
+is atomic on the event loop and the unique keys hold under concurrent requests the same way the unique indexes of
+MongoDB make them hold.
+"""
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from services.rollup import USER, VEHICLE
+from storage.base import AllocationRepository, DriverRepository, Storage, UserRepository, VehicleRepository
+
+
+def _duplicate_key_error(collection: str, index: str, key) -> DuplicateKeyError:
+    message = f"E11000 duplicate key error collection: {collection} index: {index} dup key: {key!r}"
+    return DuplicateKeyError(message, 11000)
+
+
+def _project(document: dict, fields: list = None) -> dict:
+    if fields is None:
+        return dict(document)
+    return {"_id": document['_id'], **{field: document[field] for field in fields if field in document}}
+
+
+class MemoryRepository:
+    name = None
+    # fields with a unique hash index, documents without the field (or None) are not indexed
+    unique = ()
+
+    def __init__(self):
+        self._documents = {}
+        # _ids in order, for listing in _id order
+        self._ids = []
+        self._indexes = {field: {} for field in self.unique}
+
+    def _check_unique(self, document: dict, document_id=None):
+        for field, index in self._indexes.items():
+            value = document.get(field)
+            if value is not None and index.get(value, document_id) != document_id:
+                raise _duplicate_key_error(self.name, field, value)
+
+    def _insert(self, document: dict):
+        document.setdefault('_id', ObjectId())
+        if document['_id'] in self._documents:
+            raise _duplicate_key_error(self.name, "_id", document['_id'])
+        self._check_unique(document)
+        stored = dict(document)
+        self._documents[stored['_id']] = stored
+        insort(self._ids, stored['_id'])
+        for field, index in self._indexes.items():
+            if stored.get(field) is not None:
+                index[stored[field]] = stored['_id']
+        return stored
+
+    def _find_by(self, field: str, value) -> dict|None:
+        document_id = self._indexes[field].get(value)
+        return dict(self._documents[document_id]) if document_id is not None else None
+
+    async def get(self, document_id) -> dict|None:
+        document = self._documents.get(document_id)
+        return dict(document) if document else None
+
+    async def add(self, document: dict):
+        return self._insert(document)['_id']
+
+    async def add_many(self, documents: list) -> set:
+        failed = set()
+        for index, document in enumerate(documents):
+            try:
+                self._insert(document)
+            except DuplicateKeyError:
+                failed.add(index)
+        return failed
+
+    async def list(self, skip: int, limit: int) -> list:
+        return [dict(self._documents[document_id]) for document_id in self._ids[skip:skip + limit]]
+
+
+class MemoryVehicleRepository(MemoryRepository, VehicleRepository):
+    name = "vehicles"
+    unique = ("registration_number",)
+
+    def __init__(self):
+        super().__init__()
+        # driver -> _ids of the vehicles it is assigned to
+        self._by_driver = {}
+
+    def _insert(self, document: dict):
+        stored = super()._insert(document)
+        if stored.get('driver') is not None:
+            self._by_driver.setdefault(stored['driver'], set()).add(stored['_id'])
+        return stored
+
+    def _set_driver(self, vehicle: dict, driver_id):
+        if vehicle.get('driver') is not None:
+            vehicles = self._by_driver[vehicle['driver']]
+            vehicles.discard(vehicle['_id'])
+            if not vehicles:
+                del self._by_driver[vehicle['driver']]
+        vehicle['driver'] = driver_id
+        if driver_id is not None:
+            self._by_driver.setdefault(driver_id, set()).add(vehicle['_id'])
+
+    async def get_by_registration_number(self, registration_number: str) -> dict|None:
+        return self._find_by("registration_number", registration_number)
+
+    async def get_by_driver(self, driver_id) -> dict|None:
+        vehicles = self._by_driver.get(driver_id)
+        return dict(self._documents[min(vehicles)]) if vehicles else None
+
+    async def count(self) -> int:
+        return len(self._documents)
+
+    async def find(self, exclude: list = None, limit: int = 0, fields: list = None) -> list:
+        exclude = set(exclude or ())
+        vehicles = []
+        for vehicle_id in self._ids:
+            if vehicle_id in exclude:
+                continue
+            vehicles.append(_project(self._documents[vehicle_id], fields))
+            if len(vehicles) == limit:
+                break
+        return vehicles
+
+    async def assign_driver(self, vehicle_id, driver_id, current=None) -> bool:
+        vehicle = self._documents.get(vehicle_id)
+        if not vehicle or vehicle.get('driver') != current or current == driver_id:
+            return False
+        self._set_driver(vehicle, driver_id)
+        return True
+
+    async def unassign_driver(self, driver_id):
+        vehicles = self._by_driver.get(driver_id)
+        if not vehicles:
+            return None
+        vehicle = self._documents[min(vehicles)]
+        self._set_driver(vehicle, None)
+        return vehicle['_id']
+
+
+class MemoryDriverRepository(MemoryRepository, DriverRepository):
+    name = "drivers"
+    unique = ("license_number",)
+
+    async def get_by_license_number(self, license_number: str) -> dict|None:
+        return self._find_by("license_number", license_number)
+
+
+class MemoryUserRepository(MemoryRepository, UserRepository):
+    name = "users"
+    unique = ("email",)
+
+    async def get_by_email(self, email: str) -> dict|None:
+        return self._find_by("email", email)
+
+    async def existing_ids(self, user_ids: list) -> set:
+        return {user_id for user_id in user_ids if user_id in self._documents}
+
+
+class MemoryAllocationRepository(MemoryRepository, AllocationRepository):
+    name = "allocation"
+
+    def __init__(self):
+        super().__init__()
+        # date -> {vehicle: _id}, the unique (date, vehicle) key
+        self._by_date = {}
+        # dates which have allocations, sorted for range queries
+        self._dates = []
+        # kind -> key -> allocations per date
+        self._counters = {VEHICLE: {}, USER: {}}
+
+    def _dates_between(self, start: str, end: str) -> list:
+        return self._dates[bisect_left(self._dates, start):bisect_right(self._dates, end)]
+
+    def _index(self, allocation: dict, amount: int):
+        date = allocation['date']
+        if amount > 0:
+            if date not in self._by_date:
+                self._by_date[date] = {}
+                insort(self._dates, date)
+            self._by_date[date][allocation['vehicle']] = allocation['_id']
+        else:
+            vehicles = self._by_date[date]
+            del vehicles[allocation['vehicle']]
+            if not vehicles:
+                del self._by_date[date]
+                del self._dates[bisect_left(self._dates, date)]
+        for kind in (VEHICLE, USER):
+            counter = self._counters[kind].setdefault(allocation[kind], Counter())
+            counter[date] += amount
+            if not counter[date]:
+                del counter[date]
+                if not counter:
+                    del self._counters[kind][allocation[kind]]
+
+    def _insert(self, allocation: dict):
+        if allocation['vehicle'] in self._by_date.get(allocation['date'], ()):
+            raise _duplicate_key_error(self.name, "date_vehicle", (allocation['date'], allocation['vehicle']))
+        stored = super()._insert(allocation)
+        self._index(stored, 1)
+        return stored
+
+    async def update(self, allocation: dict, fields: dict) -> bool:
+        stored = self._documents.get(allocation['_id'])
+        if not stored:
+            return False
+        updated = {**stored, **fields}
+        if (updated['date'], updated['vehicle']) != (stored['date'], stored['vehicle']) \
+                and updated['vehicle'] in self._by_date.get(updated['date'], ()):
+            raise _duplicate_key_error(self.name, "date_vehicle", (updated['date'], updated['vehicle']))
+        self._index(stored, -1)
+        stored.update(fields)
+        self._index(stored, 1)
+        return True
+
+    async def delete(self, allocation: dict) -> bool:
+        stored = self._documents.pop(allocation['_id'], None)
+        if not stored:
+            return False
+        del self._ids[bisect_left(self._ids, stored['_id'])]
+        self._index(stored, -1)
+        return True
+
+    async def vehicles_on(self, date: str) -> list:
+        return list(self._by_date.get(date, ()))
+
+    async def between(self, start: str, end: str) -> list:
+        return [{"date": date, "vehicle": vehicle}
+                for date in self._dates_between(start, end) for vehicle in self._by_date[date]]
+
+    async def count(self, kind: str, key, start: str, end: str) -> int:
+        counter = self._counters[kind].get(key, {})
+        return sum(count for date, count in counter.items() if start <= date <= end)
+
+    async def daily_counts(self, start: str, end: str) -> dict:
+        return {date: len(self._by_date[date]) for date in self._dates_between(start, end)}
+
+    def _count_keys(self, kind: str, start: str, end: str) -> Counter:
+        counts = Counter()
+        for date in self._dates_between(start, end):
+            if kind == VEHICLE:
+                counts.update(self._by_date[date].keys())
+            else:
+                counts.update(self._documents[allocation_id]['user'] for allocation_id in self._by_date[date].values())
+        return counts
+
+    async def top(self, kind: str, start: str, end: str, limit: int) -> list:
+        # None (allocations without user) sorts first on a tie, like null in MongoDB
+        counts = sorted(self._count_keys(kind, start, end).items(),
+                        key=lambda item: (-item[1], item[0] is not None, item[0] or 0))
+        return [{"key": key, "count": count} for key, count in counts[:limit]]
+
+    async def keys(self, kind: str, start: str, end: str) -> list:
+        return list(self._count_keys(kind, start, end))
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.vehicles = MemoryVehicleRepository()
+        self.drivers = MemoryDriverRepository()
+        self.users = MemoryUserRepository()
+        self.allocations = MemoryAllocationRepository()
+
+    async def ping(self) -> float:
+        started = time.perf_counter()
+        return (time.perf_counter() - started) * 1000
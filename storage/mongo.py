@@ -0,0 +1,169 @@
+"""MongoDB backend of the repositories. Lookups by id go through the read-through cache of services.cache and every
+allocation write updates the rollups of services.rollup, which answer the report queries."""
+import time
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+from services.cache import get_cached_document, invalidate_document
+from services.rollup import (
+    Generations, allocated_keys, count_allocations, daily_fleet_allocations, mark_allocations,
+    record_allocation_change, record_allocations, top_allocated
+)
+from storage.base import AllocationRepository, DriverRepository, Storage, UserRepository, VehicleRepository
+
+
+class MongoRepository:
+    name = None
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db[self.name]
+
+    async def get(self, document_id) -> dict|None:
+        return await get_cached_document(self.db, self.name, document_id)
+
+    async def add(self, document: dict):
+        result = await self.collection.insert_one(document)
+        await invalidate_document(self.db, self.name, result.inserted_id)
+        return result.inserted_id
+
+    async def add_many(self, documents: list) -> set:
+        if not documents:
+            return set()
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as error:
+            return {write_error['index'] for write_error in error.details.get('writeErrors', [])}
+        return set()
+
+    async def list(self, skip: int, limit: int) -> list:
+        return await self.collection.find().skip(skip).limit(limit).to_list(limit)
+
+
+class MongoVehicleRepository(MongoRepository, VehicleRepository):
+    name = "vehicles"
+
+    async def get_by_registration_number(self, registration_number: str) -> dict|None:
+        return await self.collection.find_one({"registration_number": registration_number})
+
+    async def get_by_driver(self, driver_id) -> dict|None:
+        return await self.collection.find_one({"driver": driver_id})
+
+    async def count(self) -> int:
+        return await self.collection.count_documents({})
+
+    async def find(self, exclude: list = None, limit: int = 0, fields: list = None) -> list:
+        query = {"_id": {"$nin": exclude}} if exclude else {}
+        projection = {"_id": 1, **{field: 1 for field in fields}} if fields is not None else None
+        return await self.collection.find(query, projection).sort("_id", 1).limit(limit).to_list(None)
+
+    async def assign_driver(self, vehicle_id, driver_id, current=None) -> bool:
+        result = await self.collection.update_one({"_id": vehicle_id, "driver": current},
+                                                  {"$set": {"driver": driver_id}})
+        await invalidate_document(self.db, self.name, vehicle_id)
+        return bool(result.modified_count)
+
+    async def unassign_driver(self, driver_id):
+        vehicle = await self.collection.find_one_and_update({"driver": driver_id}, {"$set": {"driver": None}},
+                                                            projection={"_id": 1})
+        if not vehicle:
+            return None
+        await invalidate_document(self.db, self.name, vehicle['_id'])
+        return vehicle['_id']
+
+
+class MongoDriverRepository(MongoRepository, DriverRepository):
+    name = "drivers"
+
+    async def get_by_license_number(self, license_number: str) -> dict|None:
+        return await self.collection.find_one({"license_number": license_number})
+
+
+class MongoUserRepository(MongoRepository, UserRepository):
+    name = "users"
+
+    async def get_by_email(self, email: str) -> dict|None:
+        return await self.collection.find_one({"email": email})
+
+    async def existing_ids(self, user_ids: list) -> set:
+        if not user_ids:
+            return set()
+        return set(await self.collection.distinct("_id", {"_id": {"$in": user_ids}}))
+
+
+class MongoAllocationRepository(MongoRepository, AllocationRepository):
+    name = "allocation"
+
+    def __init__(self, db):
+        super().__init__(db)
+        self.generations = Generations(db)
+
+    async def get(self, allocation_id) -> dict|None:
+        return await self.collection.find_one({"_id": allocation_id})
+
+    async def add(self, allocation: dict):
+        await mark_allocations(self.generations, [allocation])
+        await self.collection.insert_one(allocation)
+        await record_allocations(self.generations, [allocation])
+        return allocation['_id']
+
+    async def add_many(self, allocations: list) -> set:
+        await mark_allocations(self.generations, allocations)
+        failed = await super().add_many(allocations)
+        await record_allocations(self.generations, [allocation for index, allocation in enumerate(allocations)
+                                                    if index not in failed])
+        return failed
+
+    # the counters are corrected from the stored allocation, which tells the generations it is counted in
+    async def update(self, allocation: dict, fields: dict) -> bool:
+        old = await self.collection.find_one_and_update({"_id": allocation['_id']}, {"$set": fields},
+                                                        return_document=ReturnDocument.BEFORE)
+        if old is None:
+            return False
+        await record_allocation_change(self.generations, old, {**old, **fields})
+        return True
+
+    async def delete(self, allocation: dict) -> bool:
+        old = await self.collection.find_one_and_delete({"_id": allocation['_id']})
+        if old is None:
+            return False
+        await record_allocations(self.generations, [old], amount=-1)
+        return True
+
+    async def vehicles_on(self, date: str) -> list:
+        # answered from the (date, vehicle) index, the cost depends on the allocations of that day only
+        return await self.collection.distinct("vehicle", {"date": date})
+
+    async def between(self, start: str, end: str) -> list:
+        return await self.collection.find({"date": {"$gte": start, "$lte": end}},
+                                          {"_id": 0, "date": 1, "vehicle": 1}).to_list(None)
+
+    async def count(self, kind: str, key, start: str, end: str) -> int:
+        active, _ = await self.generations.get()
+        return await count_allocations(self.db, active, kind, key, start, end)
+
+    async def daily_counts(self, start: str, end: str) -> dict:
+        active, _ = await self.generations.get()
+        counts = await daily_fleet_allocations(self.db, active, start, end)
+        return {date: count for date, count in counts.items() if count}
+
+    async def top(self, kind: str, start: str, end: str, limit: int) -> list:
+        active, _ = await self.generations.get()
+        return await top_allocated(self.db, active, kind, start, end, limit)
+
+    async def keys(self, kind: str, start: str, end: str) -> list:
+        active, _ = await self.generations.get()
+        return await allocated_keys(self.db, active, kind, start, end)
+
+
+class MongoStorage(Storage):
+    def __init__(self, db):
+        self.database = db
+        self.vehicles = MongoVehicleRepository(db)
+        self.drivers = MongoDriverRepository(db)
+        self.users = MongoUserRepository(db)
+        self.allocations = MongoAllocationRepository(db)
+
+    async def ping(self) -> float:
+        started = time.perf_counter()
+        await self.database.command("ping")
+        return (time.perf_counter() - started) * 1000